@@ -2,6 +2,8 @@ from email.utils import formataddr
 import json
 import logging
 import re
+import time
+import cloudstorage as gcs
 from google.appengine.api import mail
 
 from google.appengine.ext import ndb
@@ -9,7 +11,12 @@ from google.appengine.ext.webapp.blobstore_handlers import BlobstoreDownloadHand
 import os
 from webapp2 import RequestHandler, Route, WSGIApplication, cached_property
 from webapp2_extras import sessions
-from model import Account
+from model import Account, Attachment, ATTACHMENT_GCS_URL_MAX_AGE
+import profiling
+from profiling import ProfilingMiddleware
+
+
+REDIRECT_ATTACHMENT_DOWNLOADS = os.environ.get('REDIRECT_ATTACHMENT_DOWNLOADS') == 'true'
 
 
 def json_response(func):
@@ -42,15 +49,40 @@ class SessionAwareHandlerMixin(object):
     def get_account(self):
         account_id = self.session.get('account_id')
         if account_id:
-            account = Account.get_by_id(account_id)
+            pending = self.session.get('account_pending')
+            if pending:
+                account = Account.from_pending(account_id, *pending)
+                if account.is_valid:
+                    account.keep_pending()
+            else:
+                account = Account.get_by_id(account_id)
+                if account:
+                    account.load_expiry()
             if account and account.is_valid:
                 return account
 
     def create_account(self):
-        account = Account.create()
+        # Drive-by visitors never get stored, see persist_account
+        account = Account.create(pending=True)
         self.session['account_id'] = account.key.id()
+        self.session['account_pending'] = (account.created_at, account.valid_until)
         return account
 
+    # The pending flag is only dropped once the account has been stored or discarded,
+    # should that fail the next request tries again
+    def persist_account(self, account):
+        if self.session.get('account_pending'):
+            account = account.persist()
+            del self.session['account_pending']
+        return account
+
+    def close_account(self, account):
+        if self.session.get('account_pending'):
+            account.discard()
+            del self.session['account_pending']
+        else:
+            account.close()
+
 
 class InitHandler(SessionAwareHandlerMixin, RequestHandler):
 
@@ -86,7 +118,9 @@ class ExtendTimeHandler(SessionAwareHandlerMixin, RequestHandler):
     def get(self):
         account = self.get_account()
         if account and account.is_valid:
-            account.extend_validity()
+            # A pending account is stored once, already extended
+            account.extend_validity(put=not self.session.get('account_pending'))
+            account = self.persist_account(account)
             return {
                 'account': account.api_repr()
             }
@@ -100,7 +134,7 @@ class NewAccountHandler(SessionAwareHandlerMixin, RequestHandler):
     def get(self):
         account = self.get_account()
         if account:
-            account.close()
+            self.close_account(account)
         account = self.create_account()
         return {
             'account': account.api_repr()
@@ -119,8 +153,7 @@ class MessageHandler(SessionAwareHandlerMixin, RequestHandler):
             self.abort(404)
         else:
             account = self.get_account()
-            message_account_key = message_key.parent()
-            if not account or account.key != message_account_key:
+            if not account or not message or account.key != message.owner_key:
                 self.abort(403)
             else:
                 if not message.read:
@@ -131,6 +164,14 @@ class MessageHandler(SessionAwareHandlerMixin, RequestHandler):
                 }
 
 
+def etag_matches(etag, if_none_match):
+    if not if_none_match:
+        return False
+    # If-None-Match uses the weak comparison
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
 class AttachmentDownloadHandler(SessionAwareHandlerMixin, BlobstoreDownloadHandler):
 
     def get(self, key):
@@ -141,12 +182,36 @@ class AttachmentDownloadHandler(SessionAwareHandlerMixin, BlobstoreDownloadHandl
             logging.exception(e)
             self.abort(404)
         else:
-            account = self.get_account()
-            attachment_account_key = attachment_key.parent().parent()
-            if not account or account.key != attachment_account_key:
-                self.abort(403)
+            if attachment is None:
+                self.abort(404)
+            expires = self._get_signed_url_expiry(key)
+            if expires:
+                # Shared caches would keep serving it after the account is gone
+                self.response.cache_control = 'private, max-age=%d' % (expires - time.time())
             else:
-                self.send_blob(attachment.blobkey, save_as=attachment.filename)
+                account = self.get_account()
+                if not account or account.key != attachment.owner_key:
+                    self.abort(403)
+                self.response.cache_control = 'private, max-age=%d' % max(account.expire_in, 0)
+            if REDIRECT_ATTACHMENT_DOWNLOADS:
+                # Let the client fetch bytes straight from GCS instead of streaming them through us
+                self.response.cache_control = 'private, max-age=%d' % (ATTACHMENT_GCS_URL_MAX_AGE / 2)
+                return self.redirect(attachment.gcs_url)
+            # Stored attachments never change, so the GCS object name is a strong validator
+            self.response.headers['ETag'] = attachment.etag
+            if etag_matches(attachment.etag, self.request.headers.get('If-None-Match')):
+                self.response.status_int = 304
+            else:
+                self.send_blob(attachment.blobkey, save_as=attachment.filename, use_range=True)
+
+    def _get_signed_url_expiry(self, key):
+        try:
+            expires = int(self.request.get('expires'))
+        except ValueError:
+            return None
+        signature = self.request.get('signature')
+        if signature and Attachment.is_url_signature_valid(key, expires, signature):
+            return expires
 
 
 def is_email_valid(email_address):
@@ -170,8 +235,7 @@ class ForwardMessageHandler(SessionAwareHandlerMixin, RequestHandler):
             self.abort(404)
         else:
             account = self.get_account()
-            message_account_key = message_key.parent()
-            if not account or account.key != message_account_key:
+            if not account or not message or account.key != message.owner_key:
                 self.abort(403)
             else:
                 logging.info('Forwarding message from %s to %s' % (account.email, email_address))
@@ -186,13 +250,42 @@ class ForwardMessageHandler(SessionAwareHandlerMixin, RequestHandler):
                 email_message.send()
 
 
+class GcsStatsHandler(RequestHandler):
+
+    @json_response
+    def get(self):
+        return {
+            'requests': gcs.get_request_stats(),
+            'retries': gcs.get_retry_stats()
+        }
+
+    @json_response
+    def delete(self):
+        gcs.reset_request_stats()
+        return {}
+
+
+class ProfileStatsHandler(RequestHandler):
+
+    @json_response
+    def get(self):
+        return {
+            'routes': profiling.get_stats()
+        }
+
+    @json_response
+    def delete(self):
+        profiling.reset_stats()
+        return {}
+
+
 config = {
     'webapp2_extras.sessions': {
         'secret_key': os.environ['SESSION_SECRET_KEY'],
     },
 }
 
-app = WSGIApplication([
+app = ProfilingMiddleware(WSGIApplication([
     Route('/account/init', InitHandler),
     Route('/account/inbox', InboxHandler),
     Route('/account/extend', ExtendTimeHandler),
@@ -200,4 +293,6 @@ app = WSGIApplication([
     Route('/message/<key>', MessageHandler),
     Route('/message/<key>/forward', ForwardMessageHandler),
     Route('/attachment/<key>', AttachmentDownloadHandler),
-], config=config, debug=True)
+    Route('/_debug/gcs', GcsStatsHandler),
+    Route('/_debug/profile', ProfileStatsHandler),
+], config=config, debug=True), 'api')
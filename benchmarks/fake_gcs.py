@@ -0,0 +1,244 @@
+from email.utils import formatdate
+import hashlib
+import random
+import threading
+import time
+import urllib
+import urlparse
+from xml.sax.saxutils import escape
+
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb import eventloop
+
+from cloudstorage import common
+from cloudstorage.test_utils import MockUrlFetchResult
+
+
+class Latency(object):
+    # Simulated service time of one request: a fixed part, the transfer time
+    # and, with probability tail_ratio, an extra tail latency. After
+    # start_epoch() the tail draw of a request depends only on the epoch, the
+    # request and how often it was sent in the epoch, so that runs sending
+    # extra requests (hedges, retries) still see the same latencies for the others
+
+    def __init__(self, base=0.0, bandwidth=None, tail_ratio=0.0, tail=0.0, seed=0):
+        self.base = base
+        self.bandwidth = bandwidth
+        self.tail_ratio = tail_ratio
+        self.tail = tail
+        self.seed = seed
+        self._random = random.Random(seed)
+        self._epoch = None
+        self._sent = {}
+
+    def start_epoch(self, epoch):
+        self._epoch = epoch
+        self._sent.clear()
+
+    def __call__(self, method, bytes_transferred, request=None):
+        latency = self.base
+        if self.bandwidth:
+            latency += float(bytes_transferred) / self.bandwidth
+        if self.tail_ratio:
+            draws = self._random
+            if self._epoch is not None and request is not None:
+                sent = self._sent.get(request, 0)
+                self._sent[request] = sent + 1
+                draws = random.Random(hash((self.seed, self._epoch, request, sent)))
+            if draws.random() < self.tail_ratio:
+                latency += self.tail
+        return latency
+
+
+class Faults(object):
+    # Injected failures: with probability timeout_ratio a request raises a
+    # DownloadError, with probability error_ratio it gets the error status
+    # instead of its response. Either way the request doesn't reach the objects.
+
+    TIMEOUT = 'timeout'
+
+    def __init__(self, error_ratio=0.0, timeout_ratio=0.0, status=503, seed=0):
+        self.error_ratio = error_ratio
+        self.timeout_ratio = timeout_ratio
+        self.status = status
+        self._random = random.Random(seed)
+
+    def __call__(self, method, path):
+        if not self.error_ratio and not self.timeout_ratio:
+            return None
+        roll = self._random.random()
+        if roll < self.timeout_ratio:
+            return self.TIMEOUT
+        if roll < self.timeout_ratio + self.error_ratio:
+            return self.status
+        return None
+
+
+class FakeObject(object):
+
+    def __init__(self, data, headers):
+        self.data = data
+        self.etag = '"%s"' % hashlib.md5(data).hexdigest()
+        self.created = time.time()
+        self.headers = headers
+
+
+class FakeGcs(object):
+    # Answers the GCS XML API calls the cloudstorage client makes, in process.
+    # It replaces ndb.Context.urlfetch, so everything above the HTTP layer
+    # (retries, metrics, buffering, the app itself) runs for real. Responses
+    # complete on the ndb event loop after latency() seconds.
+
+    def __init__(self, latency=None, faults=None):
+        self.latency = latency or Latency()
+        self.faults = faults or Faults()
+        self.objects = {}
+        self.uploads = {}
+        self.requests = 0
+        self.injected_faults = 0
+        self._lock = threading.Lock()
+        self._next_upload_id = 0
+        self._original_urlfetch = None
+
+    def install(self):
+        self._original_urlfetch = ndb.Context.urlfetch
+        fake = self
+
+        def urlfetch(context, url, payload=None, method='GET', headers={}, **kwargs):
+            return fake.urlfetch(url, payload, method, headers)
+        ndb.Context.urlfetch = urlfetch
+
+    def uninstall(self):
+        ndb.Context.urlfetch = self._original_urlfetch
+
+    def put(self, filename, data, **headers):
+        self.objects[filename] = FakeObject(data, headers)
+
+    def urlfetch(self, url, payload, method, headers):
+        headers = dict((k.lower(), v) for k, v in (headers or {}).iteritems())
+        parsed = urlparse.urlsplit(url)
+        path = urllib.unquote(parsed.path)
+        if path.startswith(common.LOCAL_GCS_ENDPOINT):
+            path = path[len(common.LOCAL_GCS_ENDPOINT):]
+        query = dict(urlparse.parse_qsl(parsed.query, keep_blank_values=True))
+        with self._lock:
+            self.requests += 1
+            fault = self.faults(method, path)
+            if fault:
+                self.injected_faults += 1
+                status, resp_headers, content = fault, {}, ''
+            else:
+                status, resp_headers, content = self._handle(method, path, query, headers, payload or '')
+        future = ndb.Future()
+        delay = self.latency(method, len(payload or '') + len(content), (method, path, headers.get('range')))
+        if fault == Faults.TIMEOUT:
+            error = urlfetch.DownloadError('Injected timeout: %s %s' % (method, url))
+            eventloop.queue_call(delay, future.set_exception, error)
+        else:
+            eventloop.queue_call(delay, future.set_result, MockUrlFetchResult(status, resp_headers, content))
+        return future
+
+    def _handle(self, method, path, query, headers, payload):
+        if path.count('/') == 1:
+            return self._get_bucket(path, query)
+        if 'upload_id' in query:
+            return self._put_upload(path, query['upload_id'], headers, payload)
+        if method == 'POST':
+            return self._start_upload(path, headers)
+        if method == 'PUT':
+            self.objects[path] = FakeObject(payload, self._object_headers(headers))
+            return 200, {}, ''
+        obj = self.objects.get(path)
+        if obj is None:
+            return 404, {}, ''
+        if method == 'DELETE':
+            del self.objects[path]
+            return 204, {}, ''
+        resp_headers = dict(obj.headers)
+        resp_headers.update({
+            'etag': obj.etag,
+            'last-modified': formatdate(obj.created, usegmt=True),
+            'x-goog-stored-content-length': str(len(obj.data)),
+        })
+        if method == 'HEAD':
+            resp_headers['content-length'] = str(len(obj.data))
+            return 200, resp_headers, ''
+        range_header = headers.get('range')
+        if not range_header:
+            return 200, resp_headers, obj.data
+        start, end = [int(x) for x in range_header[len('bytes='):].split('-')]
+        if start >= len(obj.data):
+            return 416, {}, ''
+        content = obj.data[start:end + 1]
+        resp_headers['content-range'] = 'bytes %d-%d/%d' % (start, start + len(content) - 1, len(obj.data))
+        return 206, resp_headers, content
+
+    def _object_headers(self, headers):
+        return dict((k, v) for k, v in headers.iteritems()
+                    if k == 'content-type' or k.startswith('x-goog-meta-'))
+
+    def _start_upload(self, path, headers):
+        self._next_upload_id += 1
+        upload_id = str(self._next_upload_id)
+        self.uploads[upload_id] = (path, [], self._object_headers(headers))
+        return 201, {'location': 'https://storage.googleapis.com%s?upload_id=%s' % (path, upload_id)}, ''
+
+    def _put_upload(self, path, upload_id, headers, payload):
+        _, chunks, object_headers = self.uploads[upload_id]
+        received = sum(len(chunk) for chunk in chunks)
+        if payload:
+            chunks.append(payload)
+            received += len(payload)
+        total = headers.get('content-range', '').rpartition('/')[2]
+        if total != '*':
+            self.objects[path] = FakeObject(''.join(chunks), object_headers)
+            del self.uploads[upload_id]
+            return 200, {}, ''
+        resp_headers = {'range': 'bytes=0-%d' % (received - 1)} if received else {}
+        return 308, resp_headers, ''
+
+    def _get_bucket(self, path, query):
+        prefix = path + '/' + query.get('prefix', '')
+        marker = path + '/' + query['marker'] if 'marker' in query else None
+        delimiter = query.get('delimiter')
+        max_keys = int(query.get('max-keys', common._MAX_GET_BUCKET_RESULT))
+        contents = []
+        prefixes = []
+        last = None
+        truncated = False
+        for filename in sorted(self.objects):
+            if not filename.startswith(prefix) or (marker and filename <= marker):
+                continue
+            if delimiter and delimiter in filename[len(prefix):]:
+                common_prefix = prefix + filename[len(prefix):].split(delimiter, 1)[0] + delimiter
+                if (prefixes and prefixes[-1] == common_prefix) or (marker and common_prefix <= marker):
+                    continue
+                entry = common_prefix
+            else:
+                entry = filename
+            if len(contents) + len(prefixes) == max_keys:
+                truncated = True
+                break
+            if entry is filename:
+                contents.append(filename)
+            else:
+                prefixes.append(entry)
+            last = entry
+        name_start = len(path) + 1
+        xml = ['<?xml version="1.0" encoding="UTF-8"?>',
+               '<ListBucketResult xmlns="%s">' % common.CS_XML_NS,
+               '<IsTruncated>%s</IsTruncated>' % ('true' if truncated else 'false')]
+        if truncated:
+            xml.append('<NextMarker>%s</NextMarker>' % escape(last[name_start:]))
+        for filename in contents:
+            obj = self.objects[filename]
+            xml.append('<Contents><Key>%s</Key><LastModified>%s</LastModified>'
+                       '<ETag>%s</ETag><Size>%d</Size></Contents>' % (
+                           escape(filename[name_start:]),
+                           time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(obj.created)),
+                           escape(obj.etag), len(obj.data)))
+        for common_prefix in prefixes:
+            xml.append('<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>' % escape(common_prefix[name_start:]))
+        xml.append('</ListBucketResult>')
+        return 200, {}, ''.join(xml)
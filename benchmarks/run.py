@@ -0,0 +1,607 @@
+import argparse
+from datetime import datetime, timedelta
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MB = 1024 * 1024
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+         'incididunt ut labore et dolore magna aliqua newsletter offer update weekly').split()
+
+SCENARIOS = ['ingest', 'inbox', 'message_view', 'cleanup', 'upload', 'parallel_read', 'hedged_read', 'retry']
+
+
+def setup_sdk(sdk_path):
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, REPO_ROOT)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.environ.setdefault('SESSION_SECRET_KEY', 'benchmark-session-secret-key')
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    if not ordered:
+        return {'n': 0}
+
+    def percentile(p):
+        return ordered[min(int(len(ordered) * p / 100.0), len(ordered) - 1)]
+    return {
+        'n': len(ordered),
+        'total': sum(ordered),
+        'mean': sum(ordered) / len(ordered),
+        'min': ordered[0],
+        'p50': percentile(50),
+        'p90': percentile(90),
+        'p99': percentile(99),
+        'max': ordered[-1],
+    }
+
+
+def histogram(samples, buckets):
+    counts = [0] * (len(buckets) + 1)
+    for sample in samples:
+        bucket = 0
+        while bucket < len(buckets) and sample > buckets[bucket]:
+            bucket += 1
+        counts[bucket] += 1
+    return {'buckets': list(buckets), 'counts': counts}
+
+
+def check(condition, message, *args):
+    if not condition:
+        raise AssertionError(message % args)
+
+
+def random_text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in xrange(words))
+
+
+def random_bytes(rng, size):
+    block = ''.join(chr(rng.randint(0, 255)) for _ in xrange(min(size, 64 * 1024)))
+    return (block * (size / len(block) + 1))[:size] if block else ''
+
+
+def newsletter_html(rng, sections, embedded):
+    parts = ['<html><head><style>td { padding: 8px; font-family: sans-serif; }</style></head>'
+             '<body><table width="600" cellpadding="0" cellspacing="0">']
+    for i in xrange(sections):
+        parts.append(
+            '<tr><td><h2>%s</h2><p style="color: #333">%s</p>'
+            '<img src="https://cdn.example.com/%d.png" width="600" alt="%s">'
+            '<p><a href="https://example.com/article/%d?utm_source=newsletter">%s</a> | '
+            '<a href="https://example.com/share/%d">Share</a></p></td></tr>' % (
+                random_text(rng, 6), random_text(rng, 80), i, random_text(rng, 3),
+                i, random_text(rng, 4), i))
+    for i in xrange(embedded):
+        parts.append('<tr><td><img src="cid:image%d@benchmark"></td></tr>' % i)
+    parts.append('<tr><td><a href="https://example.com/unsubscribe">Unsubscribe</a></td></tr>'
+                 '</table></body></html>')
+    return ''.join(parts)
+
+
+def mime_message(rng, to, body_kb, attachments, attachment_kb):
+    message = MIMEMultipart()
+    message['From'] = 'Benchmark <sender@example.com>'
+    message['To'] = to
+    message['Subject'] = random_text(rng, 5)
+    text = random_text(rng, body_kb * 1024 / 6)
+    message.attach(MIMEText(text, 'plain'))
+    message.attach(MIMEText('<html><body><p>%s</p></body></html>' % text, 'html'))
+    for i in xrange(attachments):
+        attachment = MIMEApplication(random_bytes(rng, attachment_kb * 1024))
+        attachment.add_header('Content-Disposition', 'attachment', filename='attachment-%d.bin' % i)
+        message.attach(attachment)
+    return message.as_string()
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT).strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                             cwd=REPO_ROOT).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+class Benchmark(object):
+
+    def __init__(self, quick, seed):
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+        from fake_gcs import FakeGcs
+
+        self.quick = quick
+        self.seed = seed
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_blobstore_stub()
+        self.testbed.init_taskqueue_stub(root_path=REPO_ROOT)
+        self.testbed.init_urlfetch_stub()
+        self.testbed.init_mail_stub()
+        self.gcs = FakeGcs()
+        self.gcs.install()
+
+        # The apps register their RPC hooks on import, so only import them once the stubs are active
+        import api
+        import cron
+        import email_handler
+        import model
+        import profiling
+        self.api, self.cron, self.email_handler = api, cron, email_handler
+        self.model, self.profiling = model, profiling
+
+    def close(self):
+        self.gcs.uninstall()
+        self.testbed.deactivate()
+
+    def reset(self, latency=None, faults=None):
+        from fake_gcs import Faults, Latency
+        import cloudstorage as gcs
+        from google.appengine.api import memcache
+        from google.appengine.ext import ndb
+
+        self.testbed.get_stub('datastore_v3').Clear()
+        memcache.flush_all()
+        ndb.get_context().clear_cache()
+        self.gcs.objects.clear()
+        self.gcs.uploads.clear()
+        self.gcs.requests = 0
+        self.gcs.injected_faults = 0
+        self.gcs.latency = latency or Latency()
+        self.gcs.faults = faults or Faults()
+        gcs.reset_request_stats()
+        self.profiling.reset_stats()
+        self.rng = random.Random(self.seed)
+
+    def request(self, app, path, method='GET', body=None, cookie=None):
+        import webapp2
+        from google.appengine.ext import ndb
+
+        # Every real request starts with an empty ndb context cache
+        ndb.get_context().clear_cache()
+        request = webapp2.Request.blank(path)
+        request.method = method
+        if body is not None:
+            request.body = body
+        if cookie:
+            request.headers['Cookie'] = cookie
+        response = request.get_response(app)
+        if response.status_int >= 400:
+            raise AssertionError('%s %s returned %s' % (method, path, response.status))
+        return response
+
+    def new_session(self):
+        response = self.request(self.api.app, '/account/init')
+        cookie = response.headers['Set-Cookie'].split(';', 1)[0]
+        email = json.loads(response.body)['account']['email']
+        return cookie, self.model.Account.get_pending_by_email(email).persist()
+
+    def put_messages(self, account, count, **fields):
+        from google.appengine.ext import ndb
+
+        now = datetime.now()
+        messages = [self.model.Message(
+            account=account.key,
+            sender_name='Sender %d' % i,
+            sender_address='sender%d@example.com' % i,
+            receiver_address=account.email,
+            subject=random_text(self.rng, 6),
+            date=now - timedelta(seconds=i),
+            **fields
+        ) for i in xrange(count)]
+        ndb.put_multi(messages)
+        return messages
+
+    def stats(self):
+        import cloudstorage as gcs
+
+        routes = []
+        for route_stats in self.profiling.get_stats():
+            route_stats.pop('profiles')
+            routes.append(route_stats)
+        return {'gcs_requests': gcs.get_request_stats(), 'routes': routes}
+
+    def run_ingest(self):
+        if self.quick:
+            matrix, repeat = [(2, 0, 0), (10, 2, 100)], 3
+        else:
+            matrix, repeat = [(2, 0, 0), (50, 0, 0), (10, 1, 100), (10, 5, 100), (10, 10, 500), (10, 1, 5000)], 20
+        results = []
+        for body_kb, attachments, attachment_kb in matrix:
+            self.reset()
+            account = self.model.Account.create()
+            mime = mime_message(self.rng, account.email, body_kb, attachments, attachment_kb)
+            samples = []
+            for _ in xrange(repeat):
+                start_time = time.time()
+                self.request(self.email_handler.app, '/_ah/mail/%s' % account.email, 'POST', mime)
+                samples.append(time.time() - start_time)
+            stored = len(account.messages)
+            check(stored == repeat, '%d of %d mails stored', stored, repeat)
+            check(len(self.gcs.objects) == repeat * attachments,
+                  '%d of %d attachment files stored', len(self.gcs.objects), repeat * attachments)
+            result = {
+                'body_kb': body_kb,
+                'attachments': attachments,
+                'attachment_kb': attachment_kb,
+                'mime_bytes': len(mime),
+                'latency': summarize(samples),
+                'messages_per_second': len(samples) / sum(samples),
+            }
+            result.update(self.stats())
+            results.append(result)
+        return results
+
+    def run_inbox(self):
+        sizes, repeat = ([10, 100], 5) if self.quick else ([10, 100, 500, 1000], 20)
+        results = []
+        for size in sizes:
+            self.reset()
+            cookie, account = self.new_session()
+            self.put_messages(account, size, body=random_text(self.rng, 50))
+            self.profiling.reset_stats()
+            samples = []
+            for _ in xrange(repeat):
+                start_time = time.time()
+                response = self.request(self.api.app, '/account/inbox', cookie=cookie)
+                samples.append(time.time() - start_time)
+            listed = len(json.loads(response.body)['messages'])
+            check(listed == size, '%d of %d messages listed', listed, size)
+            result = {'inbox_size': size, 'latency': summarize(samples)}
+            result.update(self.stats())
+            results.append(result)
+        return results
+
+    def run_message_view(self):
+        corpus_size, passes = (5, 2) if self.quick else (20, 3)
+        self.reset()
+        cookie, account = self.new_session()
+        messages = []
+        for _ in xrange(corpus_size):
+            embedded = self.rng.randint(0, 8)
+            message = self.put_messages(account, 1, html=newsletter_html(self.rng, self.rng.randint(5, 60), embedded))[0]
+            for i in xrange(embedded):
+                self.model.Attachment(
+                    parent=message.key,
+                    account=account.key,
+                    filename='image%d.png' % i,
+                    content_id='<image%d@benchmark>' % i,
+                    size=1024,
+                    gcs_filename='%sbenchmark/%d/image%d' % (self.model.hourly_attachments_dir(), message.key.id(), i)
+                ).put()
+            messages.append(message)
+        self.profiling.reset_stats()
+        samples = []
+        for _ in xrange(passes):
+            for message in messages:
+                start_time = time.time()
+                self.request(self.api.app, '/message/%s' % message.key.urlsafe(), cookie=cookie)
+                samples.append(time.time() - start_time)
+        result = {
+            'corpus_size': corpus_size,
+            'mean_html_bytes': sum(len(message.html) for message in messages) / len(messages),
+            'latency': summarize(samples),
+        }
+        result.update(self.stats())
+        return result
+
+    def run_cleanup(self):
+        from google.appengine.ext import ndb
+
+        accounts_count, messages_per_account, attachments_per_message = (20, 3, 2) if self.quick else (200, 5, 2)
+        self.reset()
+        expired = datetime.now() - timedelta(minutes=10)
+        hour = (datetime.now() - timedelta(hours=3)).strftime(self.model.ATTACHMENT_HOUR_FORMAT)
+        accounts = [self.model.Account(email='expired%d@example.com' % i, valid_until=expired)
+                    for i in xrange(accounts_count)]
+        ndb.put_multi(accounts)
+        attachments = []
+        for account in accounts:
+            for message in self.put_messages(account, messages_per_account, body='body'):
+                for i in xrange(attachments_per_message):
+                    gcs_filename = '%s%s/%d/%d' % (self.model.hourly_attachments_dir(), hour, message.key.id(), i)
+                    self.gcs.put(gcs_filename, random_bytes(self.rng, 10 * 1024))
+                    attachments.append(self.model.Attachment(
+                        parent=message.key, account=account.key, filename='%d.bin' % i, size=10 * 1024,
+                        gcs_filename=gcs_filename))
+        ndb.put_multi(attachments)
+
+        start_time = time.time()
+        self.request(self.cron.app, '/_cron/clearAccounts')
+        clear_seconds = time.time() - start_time
+        start_time = time.time()
+        drop_runs = 0
+        while self.gcs.objects and drop_runs < 100:
+            self.request(self.cron.app, '/_cron/dropExpiredAttachments')
+            drop_runs += 1
+        drop_seconds = time.time() - start_time
+        check(all(account.cleared for account in ndb.get_multi([account.key for account in accounts])),
+              'Not every expired account was cleared')
+        check(not self.gcs.objects, '%d attachment files left after dropping', len(self.gcs.objects))
+        result = {
+            'accounts': accounts_count,
+            'messages': accounts_count * messages_per_account,
+            'attachments': len(attachments),
+            'clear_seconds': clear_seconds,
+            'accounts_per_second': accounts_count / clear_seconds,
+            'messages_per_second': accounts_count * messages_per_account / clear_seconds,
+            'drop_runs': drop_runs,
+            'drop_seconds': drop_seconds,
+            'files_left': len(self.gcs.objects),
+            'files_dropped_per_second': (len(attachments) - len(self.gcs.objects)) / drop_seconds,
+        }
+        result.update(self.stats())
+        return result
+
+    def run_upload(self):
+        import cloudstorage as gcs
+        from fake_gcs import Latency
+
+        sizes, repeat = ([1, 5], 1) if self.quick else ([1, 10, 50], 3)
+        # Time the producer takes per written chunk, e.g. reading or encoding it,
+        # which async_flush can overlap with the upload of the previous chunk
+        produce_seconds = 256 * 1024 / (50.0 * MB)
+        results = []
+        for size_mb in sizes:
+            for async_flush in (False, True):
+                self.reset(Latency(base=0.03, bandwidth=50 * MB))
+                chunk = random_bytes(self.rng, 256 * 1024)
+                samples = []
+                for i in xrange(repeat):
+                    start_time = time.time()
+                    with gcs.open('/bucket/upload/%d' % i, 'w', 'application/octet-stream',
+                                  async_flush=async_flush) as f:
+                        for _ in xrange(size_mb * 4):
+                            time.sleep(produce_seconds)
+                            f.write(chunk)
+                    samples.append(time.time() - start_time)
+                result = {
+                    'size_mb': size_mb,
+                    'async_flush': async_flush,
+                    'produce_seconds_per_chunk': produce_seconds,
+                    'latency': summarize(samples),
+                    'mb_per_second': size_mb * len(samples) / sum(samples),
+                }
+                result.update(self.stats())
+                results.append(result)
+        return results
+
+    def run_parallel_read(self):
+        import cloudstorage as gcs
+        from fake_gcs import Latency
+
+        sizes = [10] if self.quick else [10, 50, 100]
+        configs = [
+            ('read_all', {}, None),
+            ('chunked', {}, MB),
+            ('chunked_read_ahead', {'read_ahead': 4, 'max_read_buffer_size': 8 * MB}, MB),
+        ]
+        results = []
+        for size_mb in sizes:
+            for name, options, chunk_size in configs:
+                # Per request bandwidth, so that requests in flight together finish sooner
+                self.reset(Latency(base=0.03, bandwidth=25 * MB))
+                self.gcs.put('/bucket/read/file', random_bytes(self.rng, size_mb * MB))
+                start_time = time.time()
+                with gcs.open('/bucket/read/file', **options) as f:
+                    if chunk_size:
+                        while f.read(chunk_size):
+                            pass
+                    else:
+                        f.read()
+                seconds = time.time() - start_time
+                result = {
+                    'size_mb': size_mb,
+                    'mode': name,
+                    'options': options,
+                    'seconds': seconds,
+                    'mb_per_second': size_mb / seconds,
+                    'fake_gcs_requests': self.gcs.requests,
+                }
+                result.update(self.stats())
+                results.append(result)
+        return results
+
+    def run_hedged_read(self):
+        import cloudstorage as gcs
+        from cloudstorage import api_utils, storage_api
+        from fake_gcs import Latency
+
+        reads = 30 if self.quick else 200
+
+        results = []
+        for hedge in (False, True):
+            # Tail requests have to be rarer than 100 - HEDGE_PERCENTILE percent,
+            # otherwise the hedge delay is the tail latency itself
+            self.reset(Latency(base=0.02, tail_ratio=0.015, tail=0.5, seed=self.seed))
+            self.gcs.put('/bucket/read/file', random_bytes(self.rng, 4 * MB))
+            # Hedging only starts once there are enough segment latencies to estimate the percentile
+            for _ in xrange(storage_api._segment_latencies.min_samples):
+                with gcs.open('/bucket/read/file', read_buffer_size=256 * 1024) as f:
+                    f.read()
+            gcs.reset_request_stats()
+            hedges_before = storage_api._hedge_budget.stats()['retries']
+            samples = []
+            for i in xrange(reads):
+                # Both arms see the same latencies for the requests they have in common
+                self.gcs.latency.start_epoch(i)
+                start_time = time.time()
+                with gcs.open('/bucket/read/file', read_buffer_size=256 * 1024, hedge_reads=hedge) as f:
+                    f.read()
+                samples.append(time.time() - start_time)
+            hedged_requests = storage_api._hedge_budget.stats()['retries'] - hedges_before
+            if hedge:
+                check(hedged_requests > 0, 'No read was hedged')
+            result = {
+                'hedge': hedge,
+                'latency': summarize(samples),
+                'histogram': histogram(samples, api_utils.RequestStats.LATENCY_BUCKETS),
+                'hedged_requests': hedged_requests,
+            }
+            result.update(self.stats())
+            results.append(result)
+        return results
+
+    def check_jitter(self):
+        from cloudstorage import api_utils
+
+        samples = 200 if self.quick else 2000
+        params = api_utils.RetryParams(initial_delay=0.1, max_delay=2.0, min_retries=8, max_retries=8)
+        exact = api_utils.RetryParams(initial_delay=0.1, max_delay=2.0, min_retries=8, max_retries=8, jitter=False)
+        results = []
+        for n in xrange(1, params.max_retries + 1):
+            bound = min(params.initial_delay * params.backoff_factor ** (n - 1), params.max_delay)
+            delays = [params.delay(n, time.time()) for _ in xrange(samples)]
+            check(min(delays) >= 0 and max(delays) <= bound,
+                  'Retry %d delays %.4f..%.4f outside of 0..%.4f', n, min(delays), max(delays), bound)
+            check(min(delays) < bound / 4 and max(delays) > bound * 3 / 4,
+                  'Retry %d delays %.4f..%.4f not spread over 0..%.4f', n, min(delays), max(delays), bound)
+            check(abs(exact.delay(n, time.time()) - bound) < 1e-9, 'Retry %d delay without jitter is not %.4f', n, bound)
+            results.append({'retry': n, 'bound': bound, 'delays': summarize(delays)})
+        check(params.delay(params.max_retries + 1, time.time()) == -1, 'Retried more than max_retries times')
+        return results
+
+    def run_retry(self):
+        import cloudstorage as gcs
+        from cloudstorage import api_utils, storage_api
+        from fake_gcs import Faults
+
+        operations = 50 if self.quick else 500
+        retry_params = gcs.RetryParams(initial_delay=0.001, max_delay=0.01, max_retry_period=1.0)
+        cases = [
+            ('errors', Faults(error_ratio=0.05, seed=self.seed)),
+            ('timeouts', Faults(timeout_ratio=0.05, seed=self.seed)),
+            ('outage', Faults(error_ratio=1.0)),
+        ]
+        results = {'jitter': self.check_jitter()}
+        original_budget, original_breaker = api_utils._retry_budget, storage_api._circuit_breaker
+        # A breaker that never opens, so that every failure goes through the retries
+        storage_api._circuit_breaker = api_utils._CircuitBreaker(min_requests=sys.maxint)
+        try:
+            for name, faults in cases:
+                self.reset(faults=faults)
+                budget = api_utils._retry_budget = api_utils._RetryBudget()
+                self.gcs.put('/bucket/retry/file', 'data')
+                failed = 0
+                start_time = time.time()
+                for _ in xrange(operations):
+                    try:
+                        gcs.stat('/bucket/retry/file', retry_params=retry_params)
+                    except gcs.Error:
+                        failed += 1
+                seconds = time.time() - start_time
+                stats = gcs.get_retry_stats()
+                check(stats['attempts'] == operations,
+                      '%s: %d first attempts counted for %d operations', name, stats['attempts'], operations)
+                check(stats['attempts'] + stats['retries'] == self.gcs.requests,
+                      '%s: %d attempts and %d retries counted for %d requests sent',
+                      name, stats['attempts'], stats['retries'], self.gcs.requests)
+                check(stats['retries'] <= budget.max_tokens + budget.ratio * operations,
+                      '%s: %d retries exceed the budget', name, stats['retries'])
+                check(stats['tokens'] >= 0, '%s: retry budget overdrawn', name)
+                check(stats['retries'] > 0, '%s: nothing was retried', name)
+                if faults.error_ratio == 1.0:
+                    check(failed == operations, '%s: %d operations succeeded', name, operations - failed)
+                    check(stats['rejected_retries'] > 0, '%s: retry budget never ran out', name)
+                results[name] = {
+                    'operations': operations,
+                    'failed': failed,
+                    'seconds': seconds,
+                    'injected_faults': self.gcs.injected_faults,
+                    'retry_stats': stats,
+                }
+        finally:
+            api_utils._retry_budget, storage_api._circuit_breaker = original_budget, original_breaker
+        return results
+
+
+def flatten(value, prefix=''):
+    if isinstance(value, dict):
+        items = value.iteritems()
+    elif isinstance(value, list):
+        items = enumerate(value)
+    else:
+        if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            yield prefix, value
+        return
+    for key, item in items:
+        for leaf in flatten(item, '%s.%s' % (prefix, key) if prefix else str(key)):
+            yield leaf
+
+
+def compare(baseline, results, threshold):
+    baseline_values = dict(flatten(baseline['scenarios']))
+    for path, value in flatten(results['scenarios']):
+        if '.gcs_requests.' in path or '.routes.' in path:
+            continue
+        base = baseline_values.get(path)
+        if not base:
+            continue
+        change = (value - base) / float(base)
+        if abs(change) >= threshold:
+            print '%-70s %12.4f -> %12.4f (%+.0f%%)' % (path, base, value, change * 100)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks tethbox handlers and the GCS client on the App Engine testbed stubs '
+                    'with an in-process fake GCS, and writes the results as JSON.')
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the App Engine Python SDK (default: $APPENGINE_SDK)')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='scenario to run, may be repeated (default: all)')
+    parser.add_argument('--quick', action='store_true',
+                        help='smaller inputs, for a smoke run; every scenario still checks its results')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', metavar='BASELINE_JSON',
+                        help='print metrics that changed by more than --threshold against this earlier output')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args()
+    if not args.sdk:
+        parser.error('--sdk or $APPENGINE_SDK is required')
+    setup_sdk(args.sdk)
+
+    commit, dirty = git_commit()
+    results = {
+        'commit': commit,
+        'dirty': dirty,
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'quick': args.quick,
+        'seed': args.seed,
+        'scenarios': {},
+    }
+    benchmark = Benchmark(args.quick, args.seed)
+    try:
+        for scenario in args.scenario or SCENARIOS:
+            print 'Running %s...' % scenario
+            results['scenarios'][scenario] = getattr(benchmark, 'run_' + scenario)()
+    finally:
+        benchmark.close()
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print 'Results written to %s' % args.output
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results, args.threshold)
+
+
+if __name__ == '__main__':
+    main()
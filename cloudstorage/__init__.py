@@ -14,6 +14,7 @@
 
 """Client Library for Google Cloud Storage."""
 
+from cloudstorage.api_utils import *
 from cloudstorage.cloudstorage_api import *
 from cloudstorage.errors import *
 from cloudstorage.storage_api import *
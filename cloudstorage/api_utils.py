@@ -16,15 +16,25 @@
 
 
 
-__all__ = ['set_default_retry_params',
+__all__ = ['add_request_hook',
+           'get_request_stats',
+           'get_retry_stats',
+           'remove_request_hook',
+           'reset_request_stats',
+           'set_default_retry_params',
+           'RequestInfo',
+           'RequestStats',
            'RetryParams',
           ]
 
+import collections
 import copy
 import httplib
+import itertools
 import logging
 import math
 import os
+import random
 import threading
 import time
 import urllib
@@ -79,6 +89,368 @@ def _get_default_retry_params():
     return copy.copy(default)
 
 
+class _RetryBudget(object):
+  """Process-wide token bucket capping retries to a ratio of first attempts.
+
+  Every first attempt deposits ratio tokens, up to max_tokens. Every retry
+  takes one token. When the bucket is empty failed requests aren't retried,
+  so a service outage doesn't get amplified by every instance retrying.
+  """
+
+  def __init__(self, ratio=0.1, max_tokens=10.0):
+    """Init.
+
+    Args:
+      ratio: tokens deposited per first attempt, i.e. the sustained ratio
+        of retries to first attempts.
+      max_tokens: bucket capacity, i.e. the burst of retries allowed.
+    """
+    self.ratio = ratio
+    self.max_tokens = max_tokens
+    self._tokens = max_tokens
+    self._lock = threading.Lock()
+    self._attempts = 0
+    self._retries = 0
+    self._rejected_retries = 0
+
+  def record_attempt(self):
+    """Record a first attempt."""
+    with self._lock:
+      self._attempts += 1
+      self._tokens = min(self._tokens + self.ratio, self.max_tokens)
+
+  def try_retry(self):
+    """Take a token for a retry.
+
+    Returns:
+      True if the retry is within budget. False otherwise.
+    """
+    with self._lock:
+      if self._tokens < 1:
+        self._rejected_retries += 1
+        return False
+      self._tokens -= 1
+      self._retries += 1
+      return True
+
+  def stats(self):
+    """Returns a dict of counters since the process started."""
+    with self._lock:
+      return {'attempts': self._attempts,
+              'retries': self._retries,
+              'rejected_retries': self._rejected_retries,
+              'retry_ratio': (float(self._retries) / self._attempts
+                              if self._attempts else 0.0),
+              'tokens': self._tokens}
+
+
+_retry_budget = _RetryBudget()
+
+
+class _CircuitBreaker(object):
+  """Process-wide circuit breaker for requests to a service.
+
+  Outcomes of the requests that finished in the last window seconds are
+  kept. A request failed if it raised, got a 408 or 5xx response, or took
+  longer than slow_request seconds. Once at least min_requests finished in
+  the window and failure_ratio of them failed, the circuit opens and
+  requests are refused for reset_timeout seconds. After that a single
+  probe request is let through (half-open): the circuit closes if it
+  succeeds and opens again otherwise. A probe that hasn't been recorded
+  after another reset_timeout seconds, e.g. because its tasklet was
+  abandoned, is given up and the next request becomes the new probe.
+  """
+
+  CLOSED = 'closed'
+  OPEN = 'open'
+  HALF_OPEN = 'half-open'
+
+  def __init__(self, window=30.0, min_requests=20, failure_ratio=0.5,
+               slow_request=10.0, reset_timeout=30.0):
+    self.window = window
+    self.min_requests = min_requests
+    self.failure_ratio = failure_ratio
+    self.slow_request = slow_request
+    self.reset_timeout = reset_timeout
+    self._lock = threading.Lock()
+    self._outcomes = collections.deque()
+    self._failures = 0
+    self._state = self.CLOSED
+    self._opened_at = None
+    self._probe_ids = itertools.count(1)
+    self._probe = None
+    self._probe_started_at = None
+
+  @property
+  def state(self):
+    return self._state
+
+  def allow_request(self):
+    """Whether a request may be sent now.
+
+    Returns:
+      False if the request must not be sent. Otherwise a token to pass to
+      record() once the request finishes: True for a request sent while the
+      circuit is closed, or the id of the half-open probe.
+    """
+    with self._lock:
+      if self._state == self.CLOSED:
+        return True
+      now = time.time()
+      if ((self._state == self.OPEN and
+           now >= self._opened_at + self.reset_timeout) or
+          (self._state == self.HALF_OPEN and
+           now >= self._probe_started_at + self.reset_timeout)):
+        self._state = self.HALF_OPEN
+        self._probe = next(self._probe_ids)
+        self._probe_started_at = now
+        return self._probe
+      return False
+
+  def record(self, failed, latency, token=True):
+    """Record the outcome of a request let through by allow_request.
+
+    Outcomes of requests that were sent before the circuit opened, or of
+    probes that were given up, are ignored while it isn't closed.
+
+    Args:
+      failed: True if the request raised or got a 408 or 5xx response.
+      latency: request duration in seconds.
+      token: what allow_request returned for the request.
+    """
+    failed = failed or latency > self.slow_request
+    now = time.time()
+    with self._lock:
+      if token is not True:
+        if self._state == self.HALF_OPEN and token == self._probe:
+          self._probe = None
+          if failed:
+            self._open(now)
+          else:
+            self._state = self.CLOSED
+            self._outcomes.clear()
+            self._failures = 0
+        return
+      if self._state != self.CLOSED:
+        return
+
+      self._outcomes.append((now, failed))
+      self._failures += failed
+      while self._outcomes and self._outcomes[0][0] < now - self.window:
+        _, old_failed = self._outcomes.popleft()
+        self._failures -= old_failed
+      if (len(self._outcomes) >= self.min_requests and
+          self._failures >= self.failure_ratio * len(self._outcomes)):
+        self._open(now)
+
+  def _open(self, now):
+    logging.warning('Circuit opened after %d failures out of %d requests.',
+                    self._failures, len(self._outcomes))
+    self._state = self.OPEN
+    self._opened_at = now
+    self._outcomes.clear()
+    self._failures = 0
+
+
+class _LatencyWindow(object):
+  """Latencies of the last size requests, for percentile estimates."""
+
+  def __init__(self, size=200, min_samples=20):
+    self.min_samples = min_samples
+    self._latencies = collections.deque(maxlen=size)
+
+  def add(self, latency):
+    self._latencies.append(latency)
+
+  def percentile(self, p):
+    """Get the p-th percentile latency.
+
+    Args:
+      p: percentile between 0 and 100.
+
+    Returns:
+      Latency in seconds, or None if there are fewer than min_samples.
+    """
+    latencies = sorted(self._latencies)
+    if len(latencies) < self.min_samples:
+      return None
+    return latencies[min(int(len(latencies) * p / 100.0), len(latencies) - 1)]
+
+
+def _first_done(futures):
+  """Returns a future fulfilled with whichever of futures completes first."""
+  first = ndb.Future()
+
+  def _on_done(fut):
+    if not first.done():
+      first.set_result(fut)
+
+  for fut in futures:
+    fut.add_immediate_callback(_on_done, fut)
+  return first
+
+
+def get_retry_stats():
+  """Get retry counters of this process.
+
+  Returns:
+    A dict with the number of first attempts, retries, retries rejected by
+    the retry budget, the ratio of retries to first attempts and the tokens
+    left in the budget.
+  """
+  return _retry_budget.stats()
+
+
+class RequestInfo(collections.namedtuple(
+    'RequestInfo', ['origin', 'method', 'path_class', 'status', 'bytes_out',
+                    'bytes_in', 'retries', 'latency'])):
+  """One GCS request, including all of its retries.
+
+  Fields:
+    origin: the inbound request that made it, e.g. /_ah/mail or /attachment,
+      see _request_origin. None outside of a request.
+    method: HTTP method.
+    path_class: coarse class of the URL path, e.g. /bucket/attachments/.
+    status: HTTP status of the last attempt, or the name of the exception
+      class if it didn't get a response.
+    bytes_out: payload size.
+    bytes_in: response body size.
+    retries: number of attempts after the first one.
+    latency: seconds from the first attempt until the last one completed.
+  """
+
+  __slots__ = ()
+
+
+class RequestStats(object):
+  """Aggregates RequestInfo into counters and latency histograms.
+
+  An instance is a request hook. Requests are grouped by origin, method and
+  path class; each group counts requests per status, bytes, retries and
+  latencies in LATENCY_BUCKETS.
+  """
+
+  LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._groups = {}
+
+  def __call__(self, info):
+    """Add one request."""
+    key = (info.origin, info.method, info.path_class)
+    with self._lock:
+      group = self._groups.get(key)
+      if group is None:
+        group = self._groups[key] = {
+            'requests': 0,
+            'status': collections.defaultdict(int),
+            'bytes_out': 0,
+            'bytes_in': 0,
+            'retries': 0,
+            'latency_total': 0.0,
+            'latency_histogram': [0] * (len(self.LATENCY_BUCKETS) + 1),
+        }
+      group['requests'] += 1
+      group['status'][str(info.status)] += 1
+      group['bytes_out'] += info.bytes_out
+      group['bytes_in'] += info.bytes_in
+      group['retries'] += info.retries
+      group['latency_total'] += info.latency
+      bucket = 0
+      while (bucket < len(self.LATENCY_BUCKETS) and
+             info.latency > self.LATENCY_BUCKETS[bucket]):
+        bucket += 1
+      group['latency_histogram'][bucket] += 1
+
+  def snapshot(self):
+    """Get a copy of the aggregated stats.
+
+    Returns:
+      A list of dicts, one per origin, method and path class, sorted by
+      them. latency_histogram[i] counts requests with latency up to
+      LATENCY_BUCKETS[i] seconds, the last item counts the slower ones.
+    """
+    with self._lock:
+      result = []
+      for key in sorted(self._groups):
+        group = dict(self._groups[key])
+        group['status'] = dict(group['status'])
+        group['latency_histogram'] = list(group['latency_histogram'])
+        group['origin'], group['method'], group['path_class'] = key
+        result.append(group)
+      return result
+
+  def reset(self):
+    """Forget everything aggregated so far."""
+    with self._lock:
+      self._groups = {}
+
+
+_request_stats = RequestStats()
+_request_hooks = [_request_stats]
+
+
+def add_request_hook(hook):
+  """Call hook with a RequestInfo after every GCS request of this process.
+
+  Hooks run on the thread that made the request, so they should be quick.
+  Exceptions they raise are logged and otherwise ignored.
+
+  Args:
+    hook: a callable taking a RequestInfo.
+  """
+  _request_hooks.append(hook)
+
+
+def remove_request_hook(hook):
+  """Stop calling a hook added by add_request_hook."""
+  _request_hooks.remove(hook)
+
+
+def get_request_stats():
+  """Get the stats aggregated by the default RequestStats hook.
+
+  Returns:
+    See RequestStats.snapshot.
+  """
+  return _request_stats.snapshot()
+
+
+def reset_request_stats():
+  """Reset the stats aggregated by the default RequestStats hook."""
+  _request_stats.reset()
+
+
+def _request_origin():
+  """Classify the inbound request of this thread by its path.
+
+  Returns:
+    The first path segment, or the first two if the first one starts with
+    an underscore, e.g. /attachment, /_ah/mail or /_cron/clearAccounts.
+    None if not serving a request.
+  """
+  path = os.environ.get('PATH_INFO')
+  if not path:
+    return None
+  parts = path.split('/')
+  if parts[1].startswith('_'):
+    return '/'.join(parts[:3])
+  return '/'.join(parts[:2])
+
+
+def _record_request(method, path_class, status, bytes_out, bytes_in, retries,
+                    latency):
+  """Pass a finished GCS request to every request hook."""
+  info = RequestInfo(_request_origin(), method, path_class, status, bytes_out,
+                     bytes_in, retries, latency)
+  for hook in list(_request_hooks):
+    try:
+      hook(info)
+    except Exception:
+      logging.exception('GCS request hook %r failed.', hook)
+
+
 def _quote_filename(filename):
   """Quotes filename to use as a valid URI path.
 
@@ -118,7 +490,8 @@ class _RetryWrapper(object):
   def __init__(self,
                retry_params,
                retriable_exceptions=_RETRIABLE_EXCEPTIONS,
-               should_retry=lambda r: False):
+               should_retry=lambda r: False,
+               retry_budget=None):
     """Init.
 
     Args:
@@ -126,10 +499,14 @@ class _RetryWrapper(object):
       retriable_exceptions: a list of exception classes that are retriable.
       should_retry: a function that takes a result from the tasklet and returns
         a boolean. True if the result should be retried.
+      retry_budget: a _RetryBudget shared by the retries. If None, the
+        process-wide one is used.
     """
     self.retry_params = retry_params
     self.retriable_exceptions = retriable_exceptions
     self.should_retry = should_retry
+    self.retry_budget = retry_budget or _retry_budget
+    self.attempts = 0
 
   @ndb.tasklet
   def run(self, tasklet, **kwds):
@@ -151,8 +528,10 @@ class _RetryWrapper(object):
     """
     start_time = time.time()
     n = 1
+    self.retry_budget.record_attempt()
 
     while True:
+      self.attempts = n
       e = None
       result = None
       got_result = False
@@ -174,8 +553,11 @@ class _RetryWrapper(object):
         logging.debug('Tasklet is %r', tasklet)
 
       delay = self.retry_params.delay(n, start_time)
+      if delay >= 0 and not self.retry_budget.try_retry():
+        logging.debug('Retry budget exhausted.')
+        delay = -1
 
-      if delay <= 0:
+      if delay < 0:
         logging.debug(
             'Tasklet failed after %s attempts and %s seconds in total',
             n, time.time() - start_time)
@@ -212,6 +594,7 @@ class RetryParams(object):
                max_retry_period=30.0,
                urlfetch_timeout=None,
                save_access_token=False,
+               jitter=True,
                _user_agent=None):
     """Init.
 
@@ -236,6 +619,9 @@ class RetryParams(object):
         excessive usage of GetAccessToken API. Usually the token is cached
         in process and in memcache. In some cases, memcache isn't very
         reliable.
+      jitter: randomize each delay between 0 and the exponential backoff
+        value ("full jitter"), so clients failing together don't retry in
+        lockstep.
       _user_agent: The user agent string that you want to use in your requests.
     """
     self.backoff_factor = self._check('backoff_factor', backoff_factor)
@@ -252,6 +638,7 @@ class RetryParams(object):
       self.urlfetch_timeout = self._check('urlfetch_timeout', urlfetch_timeout)
     self.save_access_token = self._check('save_access_token', save_access_token,
                                          True, bool)
+    self.jitter = self._check('jitter', jitter, True, bool)
     self._user_agent = _user_agent or self._DEFAULT_USER_AGENT
 
     self._request_id = os.getenv('REQUEST_LOG_ID')
@@ -296,6 +683,11 @@ class RetryParams(object):
           'Value for parameter %s can not be 0' % name)
     return val
 
+  def _cache_key(self):
+    """Returns a hashable key of the settings, ignoring the owning request."""
+    return tuple(sorted((k, v) for k, v in self.__dict__.iteritems()
+                        if k != '_request_id'))
+
   def belong_to_current_request(self):
     return os.getenv('REQUEST_LOG_ID') == self._request_id
 
@@ -313,9 +705,12 @@ class RetryParams(object):
         (n > self.min_retries and
          time.time() - start_time > self.max_retry_period)):
       return -1
-    return min(
+    delay = min(
         math.pow(self.backoff_factor, n-1) * self.initial_delay,
         self.max_delay)
+    if self.jitter:
+      delay = random.uniform(0, delay)
+    return delay
 
 
 def _run_until_rpc():
@@ -21,16 +21,25 @@ from cloudstorage import api_utils, storage_api, errors, common
 
 
 __all__ = ['delete',
+           'delete_multi',
            'listbucket',
            'open',
+           'signed_url',
            'stat',
           ]
 
-import logging
+import base64
+import collections
 import StringIO
+import time
 import urllib
 import xml.etree.cElementTree as ET
 
+try:
+  from google.appengine.api import app_identity
+except ImportError:
+  from google.appengine.api import app_identity
+
 
 def open(filename,
          mode='r',
@@ -38,6 +47,10 @@ def open(filename,
          options=None,
          read_buffer_size=storage_api.ReadBuffer.DEFAULT_BUFFER_SIZE,
          retry_params=None,
+         read_ahead=1,
+         max_read_buffer_size=None,
+         hedge_reads=False,
+         async_flush=False,
          _account_id=None):
   """Opens a Google Cloud Storage file and returns it as a File-like object.
 
@@ -58,8 +71,19 @@ def open(filename,
       and prefetches another one. To minimize blocking for large files,
       always read by buffer size. To minimize number of RPC requests for
       small files, set a large buffer size. Max is 30MB.
+    read_ahead: Number of buffers read prefetches. Only valid in reading
+      mode.
+    max_read_buffer_size: Size the read buffer may grow to while the file
+      is read sequentially. Defaults to read_buffer_size. Max is 30MB.
+      Only valid in reading mode.
+    hedge_reads: True to send a duplicate request when a read takes
+      unusually long, and use whichever response arrives first. Only valid
+      in reading mode.
     retry_params: An instance of api_utils.RetryParams for subsequent calls
       to GCS from this file handle. If None, the default one is used.
+    async_flush: True to keep accepting writes while the previous chunk
+      is being uploaded. Errors are raised by a later write or close.
+      Only valid in writing mode.
     _account_id: Internal-use only.
 
   Returns:
@@ -79,14 +103,18 @@ def open(filename,
 
   if mode == 'w':
     common.validate_options(options)
-    return storage_api.StreamingBuffer(api, filename, content_type, options)
+    return storage_api.StreamingBuffer(api, filename, content_type, options,
+                                       async_flush=async_flush)
   elif mode == 'r':
     if content_type or options:
       raise ValueError('Options and content_type can only be specified '
                        'for writing mode.')
     return storage_api.ReadBuffer(api,
                                   filename,
-                                  buffer_size=read_buffer_size)
+                                  buffer_size=read_buffer_size,
+                                  read_ahead=read_ahead,
+                                  max_buffer_size=max_read_buffer_size,
+                                  hedge=hedge_reads)
   else:
     raise ValueError('Invalid mode %s.' % mode)
 
@@ -112,6 +140,51 @@ def delete(filename, retry_params=None, _account_id=None):
                       body=content)
 
 
+def delete_multi(filenames, max_concurrent=10, retry_params=None,
+                 _account_id=None):
+  """Delete many Google Cloud Storage files concurrently.
+
+  A failure to delete one file doesn't stop the others from being deleted.
+
+  Args:
+    filenames: A list of Google Cloud Storage filenames of form
+      '/bucket/filename'.
+    max_concurrent: Max number of delete requests in flight at a time.
+    retry_params: An api_utils.RetryParams for these calls to GCS. If None,
+      the default one is used.
+    _account_id: Internal-use only.
+
+  Returns:
+    A list with one item per filename, in the same order. The item is None
+    if the file was deleted, or the errors.Error raised for it otherwise,
+    e.g. errors.NotFoundError if it didn't exist prior to deletion.
+  """
+  api = storage_api._get_storage_api(retry_params=retry_params,
+                                     account_id=_account_id)
+  for filename in filenames:
+    common.validate_file_path(filename)
+  results = [None] * len(filenames)
+  pending = collections.deque()
+
+  def _wait_for_oldest():
+    i, filename, fut = pending.popleft()
+    try:
+      status, resp_headers, content = fut.get_result()
+      errors.check_status(status, [204], filename, resp_headers=resp_headers,
+                          body=content)
+    except errors.Error, e:
+      results[i] = e
+
+  for i, filename in enumerate(filenames):
+    if len(pending) >= max_concurrent:
+      _wait_for_oldest()
+    filename = api_utils._quote_filename(filename)
+    pending.append((i, filename, api.delete_object_async(filename)))
+  while pending:
+    _wait_for_oldest()
+  return results
+
+
 def stat(filename, retry_params=None, _account_id=None):
   """Get GCSFileStat of a Google Cloud storage file.
 
@@ -146,6 +219,41 @@ def stat(filename, retry_params=None, _account_id=None):
   return file_stat
 
 
+def signed_url(filename, expires_in=300, method='GET', query_params=None,
+               _account_id=None):
+  """Returns a signed URL granting temporary access to a GCS file.
+
+  The URL is signed with the app's service account, so clients can fetch
+  the object straight from Google Cloud Storage without the request
+  going through the app. On dev appserver the URL points to the local
+  stub, which ignores the signature.
+
+  Args:
+    filename: A Google Cloud Storage filename of form '/bucket/filename'.
+    expires_in: Number of seconds the URL stays valid.
+    method: HTTP method the URL is valid for.
+    query_params: A str->str dict of additional query parameters, e.g.
+      {'response-content-disposition': 'attachment; filename="a.txt"'}.
+    _account_id: Internal-use only.
+
+  Returns:
+    The signed URL as str.
+  """
+  common.validate_file_path(filename)
+  api = storage_api._get_storage_api(retry_params=None,
+                                     account_id=_account_id)
+  filename = api_utils._quote_filename(filename)
+  expiration = int(time.time() + expires_in)
+  string_to_sign = '\n'.join([method, '', '', str(expiration), filename])
+  _, signature = app_identity.sign_blob(string_to_sign)
+  params = {'GoogleAccessId': app_identity.get_service_account_name(),
+            'Expires': expiration,
+            'Signature': base64.b64encode(signature)}
+  if query_params:
+    params.update(query_params)
+  return '%s%s?%s' % (api.api_url, filename, urllib.urlencode(params))
+
+
 def _copy2(src, dst, metadata=None, retry_params=None):
   """Copy the file content from src to dst.
 
@@ -317,88 +425,114 @@ class _Bucket(object):
       status, resp_headers, content = self._get_bucket_fut.get_result()
       errors.check_status(status, [200], self._path, resp_headers=resp_headers,
                           body=content, extras=self._options)
+      self._get_bucket_fut = None
 
-      if self._should_get_another_batch(content):
-        self._get_bucket_fut = self._api.get_bucket_async(
-            self._path + '?' + urllib.urlencode(self._options))
-      else:
-        self._get_bucket_fut = None
-
-      root = ET.fromstring(content)
-      dirs = self._next_dir_gen(root)
-      files = self._next_file_gen(root)
-      next_file = files.next()
-      next_dir = dirs.next()
-
-      while ((max_keys is None or total < max_keys) and
-             not (next_file is None and next_dir is None)):
+      for stat in self._iter_page(content):
+        if max_keys is not None and total >= max_keys:
+          return
         total += 1
-        if next_file is None:
-          self._last_yield = next_dir
-          next_dir = dirs.next()
-        elif next_dir is None:
-          self._last_yield = next_file
-          next_file = files.next()
-        elif next_dir < next_file:
-          self._last_yield = next_dir
-          next_dir = dirs.next()
-        elif next_file < next_dir:
-          self._last_yield = next_file
-          next_file = files.next()
-        else:
-          logging.error(
-              'Should never reach. next file is %r. next dir is %r.',
-              next_file, next_dir)
+        self._last_yield = stat
         if self._new_max_keys:
           self._new_max_keys -= 1
-        yield self._last_yield
+        yield stat
+
+  def _iter_page(self, content):
+    """Generator for files and directories of one GET bucket response.
+
+    The XML is parsed once, incrementally, and elements are cleared as soon
+    as they've been turned into GCSFileStat. The request for the next page
+    is sent once the elements before the first entry have been parsed, so
+    it is in flight while this page is consumed.
 
-  def _next_file_gen(self, root):
-    """Generator for next file element in the document.
+    GCS lists all files of a page before its directories, so in directory
+    emulation mode the page's files are held to merge both in order.
 
     Args:
-      root: root element of the XML tree.
+      content: response XML.
 
     Yields:
-      GCSFileStat for the next file.
+      GCSFileStat for the next file or directory.
     """
-    for e in root.getiterator(common._T_CONTENTS):
-      st_ctime, size, etag, key = None, None, None, None
-      for child in e.getiterator('*'):
-        if child.tag == common._T_LAST_MODIFIED:
-          st_ctime = common.dt_str_to_posix(child.text)
-        elif child.tag == common._T_ETAG:
-          etag = child.text
-        elif child.tag == common._T_SIZE:
-          size = child.text
-        elif child.tag == common._T_KEY:
-          key = child.text
-      yield common.GCSFileStat(self._path + '/' + key,
-                               size, etag, st_ctime)
-      e.clear()
-    yield None
-
-  def _next_dir_gen(self, root):
-    """Generator for next directory element in the document.
+    root = None
+    header = {}
+    hold_files = 'delimiter' in self._options
+    files = collections.deque()
+
+    for event, e in ET.iterparse(StringIO.StringIO(content),
+                                 events=('start', 'end')):
+      if event == 'start':
+        if root is None:
+          root = e
+        elif (header is not None and
+              e.tag in (common._T_CONTENTS, common._T_COMMON_PREFIXES)):
+          self._request_next_page(header)
+          header = None
+        continue
+
+      if e.tag == common._T_CONTENTS:
+        stat = self._file_stat(e)
+        if hold_files:
+          files.append(stat)
+        else:
+          yield stat
+      elif e.tag == common._T_COMMON_PREFIXES:
+        stat = common.GCSFileStat(
+            self._path + '/' + e.find(common._T_PREFIX).text,
+            st_size=None, etag=None, st_ctime=None, is_dir=True)
+        while files and files[0] < stat:
+          yield files.popleft()
+        yield stat
+      elif (header is not None and
+            e.tag in (common._T_IS_TRUNCATED, common._T_NEXT_MARKER)):
+        header[e.tag] = e.text
+        continue
+      else:
+        continue
+      root.clear()
+
+    if header is not None:
+      self._request_next_page(header)
+    while files:
+      yield files.popleft()
+
+  def _file_stat(self, e):
+    """Get GCSFileStat from a Contents element.
 
     Args:
-      root: root element in the XML tree.
+      e: Contents element.
 
-    Yields:
-      GCSFileStat for the next directory.
+    Returns:
+      GCSFileStat for the file.
+    """
+    st_ctime, size, etag, key = None, None, None, None
+    for child in e.getiterator('*'):
+      if child.tag == common._T_LAST_MODIFIED:
+        st_ctime = common.dt_str_to_posix(child.text)
+      elif child.tag == common._T_ETAG:
+        etag = child.text
+      elif child.tag == common._T_SIZE:
+        size = child.text
+      elif child.tag == common._T_KEY:
+        key = child.text
+    return common.GCSFileStat(self._path + '/' + key, size, etag, st_ctime)
+
+  def _request_next_page(self, header):
+    """Issue another GET bucket call if there are more results.
+
+    Args:
+      header: a dict from element tag to element value of the IsTruncated
+        and NextMarker elements of the current response.
     """
-    for e in root.getiterator(common._T_COMMON_PREFIXES):
-      yield common.GCSFileStat(
-          self._path + '/' + e.find(common._T_PREFIX).text,
-          st_size=None, etag=None, st_ctime=None, is_dir=True)
-      e.clear()
-    yield None
-
-  def _should_get_another_batch(self, content):
+    if self._should_get_another_batch(header):
+      self._get_bucket_fut = self._api.get_bucket_async(
+          self._path + '?' + urllib.urlencode(self._options))
+
+  def _should_get_another_batch(self, elements):
     """Whether to issue another GET bucket call.
 
     Args:
-      content: response XML.
+      elements: a dict from element tag to element value of the IsTruncated
+        and NextMarker elements of the response.
 
     Returns:
       True if should, also update self._options for the next request.
@@ -408,9 +542,6 @@ class _Bucket(object):
         self._options['max-keys'] <= common._MAX_GET_BUCKET_RESULT):
       return False
 
-    elements = self._find_elements(
-        content, set([common._T_IS_TRUNCATED,
-                      common._T_NEXT_MARKER]))
     if elements.get(common._T_IS_TRUNCATED, 'false').lower() != 'true':
       return False
 
@@ -420,27 +551,3 @@ class _Bucket(object):
       return False
     self._options['marker'] = next_marker
     return True
-
-  def _find_elements(self, result, elements):
-    """Find interesting elements from XML.
-
-    This function tries to only look for specified elements
-    without parsing the entire XML. The specified elements is better
-    located near the beginning.
-
-    Args:
-      result: response XML.
-      elements: a set of interesting element tags.
-
-    Returns:
-      A dict from element tag to element value.
-    """
-    element_mapping = {}
-    result = StringIO.StringIO(result)
-    for _, e in ET.iterparse(result, events=('end',)):
-      if not elements:
-        break
-      if e.tag in elements:
-        element_mapping[e.tag] = e.text
-        elements.remove(e.tag)
-    return element_mapping
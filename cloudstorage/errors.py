@@ -20,6 +20,7 @@
 
 __all__ = ['AuthorizationError',
            'check_status',
+           'CircuitOpenError',
            'Error',
            'FatalError',
            'FileClosedError',
@@ -93,6 +94,14 @@ class ServerError(TransientError):
   """HTTP >= 500 server side error."""
 
 
+class CircuitOpenError(TransientError):
+  """Request was not sent because Google Cloud Storage is failing.
+
+  Raised while the circuit breaker is open, i.e. after a sustained rate
+  of errors or slow responses, until a probe request succeeds.
+  """
+
+
 def check_status(status, expected, path, headers=None,
                  resp_headers=None, body=None, extras=None):
   """Check HTTP response status is expected.
@@ -18,7 +18,9 @@ from cloudstorage import api_utils
 
 __all__ = ['add_sync_methods']
 
+import logging
 import random
+import threading
 import time
 
 try:
@@ -73,6 +75,46 @@ def add_sync_methods(cls):
   return cls
 
 
+_token_cache = {}
+_token_refreshes = {}
+_token_cache_lock = threading.Lock()
+
+_TOKEN_MIN_VALIDITY = 30
+_TOKEN_REFRESH_TIMEOUT = 30
+_TOKEN_WAIT_INTERVAL = 0.05
+
+
+def _claim_token_refresh(key):
+  """Claim the right to refresh the process-wide cached token for key.
+
+  Only one caller per process is let through at a time. A claim older than
+  _TOKEN_REFRESH_TIMEOUT seconds is considered abandoned.
+
+  Args:
+    key: token cache key.
+
+  Returns:
+    True if the caller should refresh the token. False otherwise.
+  """
+  now = time.time()
+  with _token_cache_lock:
+    claimed_at = _token_refreshes.get(key)
+    if claimed_at is not None and claimed_at > now - _TOKEN_REFRESH_TIMEOUT:
+      return False
+    _token_refreshes[key] = now
+    return True
+
+
+def _release_token_refresh(key):
+  """Give up a claim taken with _claim_token_refresh.
+
+  Args:
+    key: token cache key.
+  """
+  with _token_cache_lock:
+    _token_refreshes.pop(key, None)
+
+
 class _AE_TokenStorage_(ndb.Model):
   """Entity to store app_identity tokens in memcache."""
 
@@ -168,29 +210,60 @@ class _RestApi(object):
 
     Yields:
       The async fetch of the url.
+
+    Every request, including its retries, is passed to the request hooks
+    in api_utils once it finishes.
     """
     retry_wrapper = api_utils._RetryWrapper(
         self.retry_params,
         retriable_exceptions=api_utils._RETRIABLE_EXCEPTIONS,
         should_retry=api_utils._should_retry)
-    resp = yield retry_wrapper.run(
-        self.urlfetch_async,
-        url=url,
-        method=method,
-        headers=headers,
-        payload=payload,
-        deadline=deadline,
-        callback=callback,
-        follow_redirects=False)
+    start_time = time.time()
+    resp = None
+    status = None
+    try:
+      resp = yield retry_wrapper.run(
+          self.urlfetch_async,
+          url=url,
+          method=method,
+          headers=headers,
+          payload=payload,
+          deadline=deadline,
+          callback=callback,
+          follow_redirects=False)
+      status = resp.status_code
+    except Exception, e:
+      status = e.__class__.__name__
+      raise
+    finally:
+      api_utils._record_request(
+          method, self._path_class(url), status, len(payload or ''),
+          len(resp.content or '') if resp is not None else 0,
+          max(retry_wrapper.attempts - 1, 0), time.time() - start_time)
     raise ndb.Return((resp.status_code, resp.headers, resp.content))
 
+  def _path_class(self, url):
+    """Classify url for request metrics. Subclasses know their URL scheme.
+
+    Args:
+      url: the requested url.
+
+    Returns:
+      The host of url.
+    """
+    return url.split('/', 3)[2] if '://' in url else url
+
   @ndb.tasklet
   def get_token_async(self, refresh=False):
     """Get an authentication token.
 
-    The token is cached in memcache, keyed by the scopes argument.
-    Uses a random token expiration headroom value generated in the constructor
-    to eliminate a burst of GET_ACCESS_TOKEN API requests.
+    The token is cached in process memory and in memcache, keyed by the
+    scopes argument. Uses a random token expiration headroom value generated
+    in the constructor to eliminate a burst of GET_ACCESS_TOKEN API requests.
+
+    If this call started refreshing the process-wide token in the
+    background, it waits for that before returning. urlfetch_async instead
+    waits for it alongside its fetch.
 
     Args:
       refresh: If True, ignore a cached token; default False.
@@ -198,7 +271,74 @@ class _RestApi(object):
     Yields:
       An authentication token. This token is guaranteed to be non-expired.
     """
+    token, background_refresh = yield self._get_token_async(refresh)
+    if background_refresh is not None:
+      yield background_refresh
+    raise ndb.Return(token)
+
+  @ndb.tasklet
+  def _get_token_async(self, refresh=False):
+    """Get an authentication token, see get_token_async.
+
+    Once the process-wide token is within the headroom of its expiration,
+    a single caller starts refreshing it in the background while everyone
+    keeps using the cached one. Callers only wait for a new token when
+    there is none, it is about to expire or refresh is True. Even then
+    only one of them fetches it, the others wait for it to be cached.
+
+    Args:
+      refresh: If True, ignore a cached token; default False.
+
+    Yields:
+      A tuple of the token and the future of the background refresh this
+      call started, or None. The caller has to wait for that future before
+      its request ends, pending RPCs are cancelled then. It never fails.
+    """
     key = '%s,%s' % (self.service_account_id, ','.join(self.scopes))
+    cached = _token_cache.get(key)
+    if not refresh and cached is not None:
+      token, expires_at = cached
+      now = time.time()
+      if expires_at > now + self.expiration_headroom:
+        raise ndb.Return((token, None))
+      if expires_at > now + _TOKEN_MIN_VALIDITY:
+        background_refresh = None
+        if _claim_token_refresh(key):
+          background_refresh = self._refresh_token_in_background(key)
+        raise ndb.Return((token, background_refresh))
+    while not _claim_token_refresh(key):
+      yield ndb.sleep(_TOKEN_WAIT_INTERVAL)
+      latest = _token_cache.get(key)
+      if (latest is not None and latest is not cached and
+          latest[1] > time.time() + _TOKEN_MIN_VALIDITY):
+        raise ndb.Return((latest[0], None))
+    try:
+      token = yield self._refresh_token_async(key, refresh)
+    finally:
+      _release_token_refresh(key)
+    raise ndb.Return((token, None))
+
+  @ndb.tasklet
+  def _refresh_token_in_background(self, key):
+    """Refresh the token, logging instead of raising errors."""
+    try:
+      yield self._refresh_token_async(key)
+    except Exception, e:
+      logging.warning('Background access token refresh failed: %r', e)
+    finally:
+      _release_token_refresh(key)
+
+  @ndb.tasklet
+  def _refresh_token_async(self, key, refresh=False):
+    """Get a token from memcache or GetAccessToken and cache it in process.
+
+    Args:
+      key: token cache key.
+      refresh: If True, ignore a token in memcache; default False.
+
+    Yields:
+      An authentication token.
+    """
     ts = yield _AE_TokenStorage_.get_by_id_async(
         key, use_cache=True, use_memcache=True,
         use_datastore=self.retry_params.save_access_token)
@@ -212,6 +352,7 @@ class _RestApi(object):
         yield ts.put_async(memcache_timeout=timeout,
                            use_datastore=self.retry_params.save_access_token,
                            use_cache=True, use_memcache=True)
+    _token_cache[key] = (ts.token, ts.expires)
     raise ndb.Return(ts.token)
 
   @ndb.tasklet
@@ -237,17 +378,20 @@ class _RestApi(object):
     """
     headers = {} if headers is None else dict(headers)
     headers.update(self.user_agent)
-    self.token = yield self.get_token_async()
+    self.token, background_refresh = yield self._get_token_async()
     if self.token:
       headers['authorization'] = 'OAuth ' + self.token
 
     deadline = deadline or self.retry_params.urlfetch_timeout
 
     ctx = ndb.get_context()
-    resp = yield ctx.urlfetch(
+    fetch = ctx.urlfetch(
         url, payload=payload, method=method,
         headers=headers, follow_redirects=follow_redirects,
         deadline=deadline, callback=callback)
+    if background_refresh is not None:
+      yield background_refresh, fetch
+    resp = yield fetch
     raise ndb.Return(resp)
 
 
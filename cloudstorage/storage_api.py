@@ -21,7 +21,10 @@ __all__ = ['ReadBuffer',
           ]
 
 import collections
+import httplib
 import os
+import threading
+import time
 import urlparse
 
 try:
@@ -33,9 +36,21 @@ except ImportError:
 
 
 
+_thread_local_apis = threading.local()
+_circuit_breaker = api_utils._CircuitBreaker()
+_segment_latencies = api_utils._LatencyWindow()
+_hedge_budget = api_utils._RetryBudget(ratio=0.05, max_tokens=5.0)
+_SEGMENT_SUCCESS_STATUSES = (httplib.OK, httplib.PARTIAL_CONTENT)
+
+
 def _get_storage_api(retry_params, account_id=None):
   """Returns storage_api instance for API methods.
 
+  Instances are cached per thread and shared by calls with equal
+  retry_params, account_id, access token and endpoint. A cached instance
+  is handed the caller's retry_params, so it's bound to the current
+  request.
+
   Args:
     retry_params: An instance of api_utils.RetryParams. If none,
      thread's default will be used.
@@ -47,15 +62,30 @@ def _get_storage_api(retry_params, account_id=None):
     unless common.ACCESS_TOKEN is set. That token will be used to talk
     to the real GCS.
   """
-
-
-  api = _StorageApi(_StorageApi.full_control_scope,
-                    service_account_id=account_id,
-                    retry_params=retry_params)
-  if common.local_run() and not common.get_access_token():
-    api.api_url = common.local_api_url()
-  if common.get_access_token():
-    api.token = common.get_access_token()
+  if not retry_params:
+    retry_params = api_utils._get_default_retry_params()
+  access_token = common.get_access_token()
+  api_url = None
+  if common.local_run() and not access_token:
+    api_url = common.local_api_url()
+
+  apis = getattr(_thread_local_apis, 'apis', None)
+  if apis is None:
+    apis = _thread_local_apis.apis = {}
+  key = (account_id, retry_params._cache_key(), access_token, api_url)
+  api = apis.get(key)
+  if api is None:
+    api = _StorageApi(_StorageApi.full_control_scope,
+                      service_account_id=account_id,
+                      retry_params=retry_params)
+    if api_url:
+      api.api_url = api_url
+    if access_token:
+      api.token = access_token
+    apis[key] = api
+  else:
+    # Equal settings, but this request's instance, which knows its request id.
+    api.retry_params = retry_params
   return api
 
 
@@ -84,6 +114,9 @@ class _StorageApi(rest_api._RestApi):
   read_write_scope = 'https://www.googleapis.com/auth/devstorage.read_write'
   full_control_scope = 'https://www.googleapis.com/auth/devstorage.full_control'
 
+  _default_headers = (('x-goog-api-version', '2'),)
+  _forced_headers = (('accept-encoding', 'gzip, *'),)
+
   def __getstate__(self):
     """Store state as part of serialization/pickling.
 
@@ -102,6 +135,29 @@ class _StorageApi(rest_api._RestApi):
     super(_StorageApi, self).__setstate__(superstate)
     self.api_url = localstate['api_url']
 
+  def _path_class(self, url):
+    """Classify url by bucket and top level directory for request metrics.
+
+    Args:
+      url: the requested url.
+
+    Returns:
+      /bucket/ for bucket requests, /bucket/dir/ for objects in a directory
+      and /bucket/* for other objects. Resumable upload requests get an
+      ?upload_id suffix.
+    """
+    path, _, query = url[len(self.api_url):].partition('?')
+    bucket, _, name = path.lstrip('/').partition('/')
+    if not name:
+      path_class = '/%s/' % bucket
+    elif '/' in name:
+      path_class = '/%s/%s/' % (bucket, name.split('/', 1)[0])
+    else:
+      path_class = '/%s/*' % bucket
+    if 'upload_id=' in query:
+      path_class += '?upload_id'
+    return path_class
+
   @api_utils._eager_tasklet
   @ndb.tasklet
   def do_request_async(self, url, method='GET', headers=None, payload=None,
@@ -109,19 +165,34 @@ class _StorageApi(rest_api._RestApi):
     """Inherit docs.
 
     This method translates urlfetch exceptions to more service specific ones.
+
+    Requests fail fast with errors.CircuitOpenError while the circuit
+    breaker is open. The request hooks still see them, with that as status.
     """
-    if headers is None:
-      headers = {}
-    if 'x-goog-api-version' not in headers:
-      headers['x-goog-api-version'] = '2'
-    headers['accept-encoding'] = 'gzip, *'
+    circuit_token = _circuit_breaker.allow_request()
+    if not circuit_token:
+      error = errors.CircuitOpenError(
+          'Google Cloud Storage is failing, request to %s not sent.' % url)
+      api_utils._record_request(method, self._path_class(url),
+                                error.__class__.__name__, 0, 0, 0, 0.0)
+      raise error
+    request_headers = dict(self._default_headers)
+    if headers:
+      request_headers.update(headers)
+    request_headers.update(self._forced_headers)
+    headers = request_headers
+    start_time = time.time()
+    failed = True
     try:
       resp_tuple = yield super(_StorageApi, self).do_request_async(
           url, method=method, headers=headers, payload=payload,
           deadline=deadline, callback=callback)
+      failed = resp_tuple[0] == httplib.REQUEST_TIMEOUT or resp_tuple[0] >= 500
     except urlfetch.DownloadError, e:
       raise errors.TimeoutError(
           'Request to Google Cloud Storage timed out.', e)
+    finally:
+      _circuit_breaker.record(failed, time.time() - start_time, circuit_token)
 
     raise ndb.Return(resp_tuple)
 
@@ -171,46 +242,76 @@ class ReadBuffer(object):
 
   DEFAULT_BUFFER_SIZE = 1024 * 1024
   MAX_REQUEST_SIZE = 30 * DEFAULT_BUFFER_SIZE
+  MAX_PARALLEL_REQUESTS = 8
+  HEDGE_PERCENTILE = 95
 
   def __init__(self,
                api,
                path,
                buffer_size=DEFAULT_BUFFER_SIZE,
-               max_request_size=MAX_REQUEST_SIZE):
+               max_request_size=MAX_REQUEST_SIZE,
+               read_ahead=1,
+               max_buffer_size=None,
+               hedge=False):
     """Constructor.
 
     Args:
       api: A StorageApi instance.
       path: Quoted/escaped path to the object, e.g. /mybucket/myfile
       buffer_size: buffer size. The ReadBuffer keeps
-        one buffer. But there may be a pending future that contains
-        a second buffer. This size must be less than max_request_size.
+        one buffer. But there may be up to read_ahead pending futures
+        that contain the next buffers. This size must be less than
+        max_request_size.
       max_request_size: Max bytes to request in one urlfetch.
+      read_ahead: number of buffers to prefetch.
+      max_buffer_size: while the file is read sequentially, each
+        prefetched buffer is twice as large as the previous one, up to
+        this size. Seeking starts over from buffer_size. Defaults to
+        buffer_size, i.e. no growth. Must be less than max_request_size.
+      hedge: True to send a duplicate request for a segment that takes
+        longer than HEDGE_PERCENTILE of recent segment requests, and use
+        whichever response comes first. Hedges are capped at 5% of
+        segment requests per process.
     """
     self._api = api
     self._path = path
     self.name = api_utils._unquote_filename(path)
     self.closed = False
 
-    assert buffer_size <= max_request_size
+    if max_buffer_size is None:
+      max_buffer_size = buffer_size
+    assert buffer_size <= max_buffer_size <= max_request_size
+    assert read_ahead >= 1
     self._buffer_size = buffer_size
+    self._max_buffer_size = max_buffer_size
     self._max_request_size = max_request_size
+    self._read_ahead = read_ahead
+    self._hedge = hedge
     self._offset = 0
     self._buffer = _Buffer()
     self._etag = None
 
-    get_future = self._get_segment(0, self._buffer_size, check_response=False)
-
-    status, headers, content = self._api.head_object(path)
-    errors.check_status(status, [200], path, resp_headers=headers, body=content)
-    self._file_size = long(common.get_stored_content_length(headers))
+    request_headers = {'Range': 'bytes=0-%d' % (self._buffer_size - 1)}
+    status, headers, content = self._api.get_object(path,
+                                                    headers=request_headers)
+    if status == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+      # No range of an empty object is satisfiable. Let HEAD tell that
+      # case apart from a genuinely bad request.
+      status, headers, content = self._api.head_object(path)
+      errors.check_status(status, [200], path, resp_headers=headers,
+                          body=content)
+      self._file_size = long(common.get_stored_content_length(headers))
+      content = ''
+    else:
+      errors.check_status(status, [200, 206], path, request_headers,
+                          headers, body=content)
+      self._file_size = self._get_file_size(status, headers, content)
     self._check_etag(headers.get('etag'))
 
-    self._buffer_future = None
+    self._buffer_futures = collections.deque()
+    self._next_segment_size = self._buffer_size
 
     if self._file_size != 0:
-      content, check_response_closure = get_future.get_result()
-      check_response_closure()
       self._buffer.reset(content)
       self._request_next_buffer()
 
@@ -229,6 +330,9 @@ class ReadBuffer(object):
             'path': self._path,
             'buffer_size': self._buffer_size,
             'request_size': self._max_request_size,
+            'read_ahead': self._read_ahead,
+            'hedge': self._hedge,
+            'max_buffer_size': self._max_buffer_size,
             'etag': self._etag,
             'size': self._file_size,
             'offset': self._offset,
@@ -247,12 +351,16 @@ class ReadBuffer(object):
     self.name = api_utils._unquote_filename(self._path)
     self._buffer_size = state['buffer_size']
     self._max_request_size = state['request_size']
+    self._read_ahead = state.get('read_ahead', 1)
+    self._hedge = state.get('hedge', False)
+    self._max_buffer_size = state.get('max_buffer_size', self._buffer_size)
     self._etag = state['etag']
     self._file_size = state['size']
     self._offset = state['offset']
     self._buffer = _Buffer()
     self.closed = state['closed']
-    self._buffer_future = None
+    self._buffer_futures = collections.deque()
+    self._next_segment_size = self._buffer_size
     if self._remaining() and not self.closed:
       self._request_next_buffer()
 
@@ -308,7 +416,7 @@ class ReadBuffer(object):
       data_list.append(data)
       if size == 0 or not self._remaining():
         return ''.join(data_list)
-      self._buffer.reset(self._buffer_future.get_result())
+      self._buffer.reset(self._buffer_futures.popleft().get_result())
       self._request_next_buffer()
       newline_offset = self._buffer.find_newline(size)
 
@@ -321,6 +429,9 @@ class ReadBuffer(object):
   def read(self, size=-1):
     """Read data from RAW file.
 
+    Reading up to EOF fetches everything that isn't buffered yet with up
+    to MAX_PARALLEL_REQUESTS concurrent ranged requests.
+
     Args:
       size: Number of bytes to read as integer. Actual number of bytes
         read is always equal to size unless EOF is reached. If size is
@@ -336,6 +447,19 @@ class ReadBuffer(object):
     if not self._remaining():
       return ''
 
+    if size < 0 or size >= self._remaining():
+      data_list = [self._buffer.read()]
+      if self._buffer_futures:
+        start = min(self._next_offset, self._file_size)
+      else:
+        start = self._offset + len(data_list[0])
+      pending, self._buffer_futures = (self._buffer_futures,
+                                       collections.deque())
+      data_list.extend(self._iter_segments(start, self._file_size - start,
+                                           pending))
+      self._offset = self._file_size
+      return ''.join(data_list)
+
     data_list = []
     while True:
       remaining = self._buffer.remaining()
@@ -348,7 +472,7 @@ class ReadBuffer(object):
         self._offset += remaining
         data_list.append(self._buffer.read())
 
-        if self._buffer_future is None:
+        if not self._buffer_futures:
           if size < 0 or size >= self._remaining():
             needs = self._remaining()
           else:
@@ -357,27 +481,65 @@ class ReadBuffer(object):
           self._offset += needs
           break
 
-        if self._buffer_future:
-          self._buffer.reset(self._buffer_future.get_result())
-          self._buffer_future = None
+        self._buffer.reset(self._buffer_futures.popleft().get_result())
 
-    if self._buffer_future is None:
-      self._request_next_buffer()
+    self._request_next_buffer()
     return ''.join(data_list)
 
+  def readinto(self, b):
+    """Read data from RAW file into a preallocated, writable buffer.
+
+    Unlike read(), no intermediate strings are built: bytes are copied
+    straight from the fetched segments into b.
+
+    Args:
+      b: an object supporting the writable buffer interface, e.g. a
+        bytearray or a memoryview of one.
+
+    Returns:
+      Number of bytes read. Always len(b) unless EOF is reached; 0 at EOF.
+
+    Raises:
+      IOError: When this buffer is closed.
+    """
+    self._check_open()
+    view = memoryview(b)
+    size = len(view)
+    bytes_read = 0
+    while bytes_read < size and self._remaining():
+      if not self._buffer.remaining():
+        if not self._buffer_futures:
+          needs = min(size - bytes_read, self._remaining())
+          for content in self._iter_segments(self._offset, needs):
+            view[bytes_read:bytes_read + len(content)] = content
+            bytes_read += len(content)
+            self._offset += len(content)
+          break
+        self._buffer.reset(self._buffer_futures.popleft().get_result())
+      copied = self._buffer.readinto(view[bytes_read:])
+      bytes_read += copied
+      self._offset += copied
+
+    self._request_next_buffer()
+    return bytes_read
+
   def _remaining(self):
     return self._file_size - self._offset
 
   def _request_next_buffer(self):
-    """Request next buffer.
+    """Request next buffers until read_ahead of them are pending.
 
     Requires self._offset and self._buffer are in consistent state.
     """
-    self._buffer_future = None
-    next_offset = self._offset + self._buffer.remaining()
-    if next_offset != self._file_size:
-      self._buffer_future = self._get_segment(next_offset,
-                                              self._buffer_size)
+    if not self._buffer_futures:
+      self._next_offset = self._offset + self._buffer.remaining()
+    while (len(self._buffer_futures) < self._read_ahead and
+           self._next_offset < self._file_size):
+      self._buffer_futures.append(
+          self._get_segment(self._next_offset, self._next_segment_size))
+      self._next_offset += self._next_segment_size
+      self._next_segment_size = min(self._next_segment_size * 2,
+                                    self._max_buffer_size)
 
   def _get_segments(self, start, request_size):
     """Get segments of the file from Google Storage as a list.
@@ -393,19 +555,38 @@ class ReadBuffer(object):
     Returns:
       A list of file segments in order
     """
-    if not request_size:
-      return []
+    return list(self._iter_segments(start, request_size))
+
+  def _iter_segments(self, start, request_size, pending=()):
+    """Fetch segments of the file concurrently and yield them in order.
+
+    At most MAX_PARALLEL_REQUESTS segment requests are in flight at a time.
+    The range is split so that each of them gets a similar share of it,
+    but no segment is smaller than the buffer size or larger than
+    max_request_size.
+
+    Args:
+      start: start offset to request. Inclusive. Have to be within the
+        range of the file.
+      request_size: number of bytes to request.
+      pending: futures of segments that precede start and are already
+        in flight. Their results are yielded first.
 
+    Yields:
+      File segments in order.
+    """
+    futures = collections.deque(pending)
     end = start + request_size
-    futures = []
+    segment_size = -(-request_size // self.MAX_PARALLEL_REQUESTS)
+    segment_size = min(max(segment_size, self._buffer_size),
+                       self._max_request_size)
 
-    while request_size > self._max_request_size:
-      futures.append(self._get_segment(start, self._max_request_size))
-      request_size -= self._max_request_size
-      start += self._max_request_size
-    if start < end:
-      futures.append(self._get_segment(start, end-start))
-    return [fut.get_result() for fut in futures]
+    while futures or start < end:
+      while start < end and len(futures) < self.MAX_PARALLEL_REQUESTS:
+        size = min(segment_size, end - start)
+        futures.append(self._get_segment(start, size))
+        start += size
+      yield futures.popleft().get_result()
 
   @ndb.tasklet
   def _get_segment(self, start, request_size, check_response=True):
@@ -433,8 +614,12 @@ class ReadBuffer(object):
     end = start + request_size - 1
     content_range = '%d-%d' % (start, end)
     headers = {'Range': 'bytes=' + content_range}
-    status, resp_headers, content = yield self._api.get_object_async(
-        self._path, headers=headers)
+    if self._hedge:
+      status, resp_headers, content = yield self._get_object_hedged_async(
+          headers)
+    else:
+      status, resp_headers, content = yield self._get_object_timed_async(
+          headers)
     def _checker():
       errors.check_status(status, [200, 206], self._path, headers,
                           resp_headers, body=content)
@@ -444,14 +629,78 @@ class ReadBuffer(object):
       raise ndb.Return(content)
     raise ndb.Return(content, _checker)
 
+  def _get_object_timed_async(self, headers):
+    """GET the object, adding the request's latency to _segment_latencies.
+
+    Every segment request is recorded, hedged or not, so the hedging delay
+    isn't skewed by the requests it cut short.
+
+    Args:
+      headers: request headers.
+
+    Returns:
+      A future of the (status, headers, content) tuple.
+    """
+    start_time = time.time()
+    future = self._api.get_object_async(self._path, headers=headers)
+    future.add_immediate_callback(
+        lambda: _segment_latencies.add(time.time() - start_time))
+    return future
+
+  @ndb.tasklet
+  def _get_object_hedged_async(self, headers):
+    """GET the object, backing a slow request with a duplicate one.
+
+    Args:
+      headers: request headers.
+
+    Yields:
+      The (status, headers, content) tuple of the first request to succeed,
+      or of the last one to fail if none did.
+    """
+    _hedge_budget.record_attempt()
+    futures = [self._get_object_timed_async(headers)]
+    delay = _segment_latencies.percentile(self.HEDGE_PERCENTILE)
+    if delay is not None:
+      timer = ndb.sleep(delay)
+      done = yield api_utils._first_done(futures + [timer])
+      if done is timer and _hedge_budget.try_retry():
+        futures.append(self._get_object_timed_async(headers))
+    while True:
+      done = yield api_utils._first_done(futures)
+      futures.remove(done)
+      if not futures or (done.get_exception() is None and
+                         done.get_result()[0] in _SEGMENT_SUCCESS_STATUSES):
+        break
+    raise ndb.Return(done.get_result())
+
+  def _get_file_size(self, status, headers, content):
+    """Get the file size from the response to the first ranged GET.
+
+    Args:
+      status: HTTP response status. 206, or 200 if the whole file was
+        returned.
+      headers: HTTP response headers.
+      content: HTTP response body.
+
+    Returns:
+      The file size as long.
+    """
+    if status == httplib.OK:
+      return long(len(content))
+    content_range = headers.get('content-range', '')
+    _, _, total = content_range.rpartition('/')
+    if total.isdigit():
+      return long(total)
+    return long(common.get_stored_content_length(headers))
+
   def _check_etag(self, etag):
     """Check if etag is the same across requests to GCS.
 
     If self._etag is None, set it. If etag is set, check that the new
     etag equals the old one.
 
-    In the __init__ method, we fire one HEAD and one GET request using
-    ndb tasklet. One of them would return first and set the first value.
+    The first value is set from the ranged GET in the __init__ method.
 
     Args:
       etag: etag from a GCS HTTP response. None if etag is not part of the
@@ -471,7 +720,7 @@ class ReadBuffer(object):
   def close(self):
     self.closed = True
     self._buffer = None
-    self._buffer_future = None
+    self._buffer_futures = None
 
   def __enter__(self):
     return self
@@ -498,7 +747,8 @@ class ReadBuffer(object):
     self._check_open()
 
     self._buffer.reset()
-    self._buffer_future = None
+    self._buffer_futures.clear()
+    self._next_segment_size = self._buffer_size
 
     if whence == os.SEEK_SET:
       self._offset = offset
@@ -548,6 +798,7 @@ class _Buffer(object):
 
   def reset(self, content='', offset=0):
     self._buffer = content
+    self._view = memoryview(content)
     self._offset = offset
 
   def read(self, size=-1):
@@ -580,6 +831,20 @@ class _Buffer(object):
     self._offset += len(result)
     return result
 
+  def readinto(self, view):
+    """Copies bytes from self._buffer into view and update related offsets.
+
+    Args:
+      view: a writable memoryview to copy into, starting at its beginning.
+
+    Returns:
+      Number of bytes copied.
+    """
+    size = min(len(view), self.remaining())
+    view[:size] = self._view[self._offset:self._offset + size]
+    self._offset += size
+    return size
+
   def remaining(self):
     return len(self._buffer) - self._offset
 
@@ -605,6 +870,14 @@ class StreamingBuffer(object):
 
   The exact sequence of calls and use of headers is documented at
   https://developers.google.com/storage/docs/developer-guide#unknownresumables
+
+  Written strings are kept as they are until a request payload is joined
+  from them. A string straddling the end of a payload is only sliced for
+  the part sent; the rest stays in the buffer by offset, not as a copy.
+
+  The resumable upload is only started once _flushsize bytes have been
+  buffered or flush() has at least one block to send. Smaller objects are
+  created with a single PUT on close().
   """
 
   _blocksize = 256 * 1024
@@ -617,7 +890,8 @@ class StreamingBuffer(object):
                api,
                path,
                content_type=None,
-               gcs_headers=None):
+               gcs_headers=None,
+               async_flush=False):
     """Constructor.
 
     Args:
@@ -627,8 +901,10 @@ class StreamingBuffer(object):
         delegate to Google Cloud Storage.
       gcs_headers: additional gs headers as a str->str dict, e.g
         {'x-goog-acl': 'private', 'x-goog-meta-foo': 'foo'}.
-    Raises:
-      IOError: When this location can not be found.
+      async_flush: True to return from write() and flush() while the last
+        chunk is still being uploaded. Chunks are still sent one at a time
+        and in order; an upload error is raised by the next call that
+        sends data.
     """
     assert self._maxrequestsize > self._blocksize
     assert self._maxrequestsize % self._blocksize == 0
@@ -641,23 +917,19 @@ class StreamingBuffer(object):
     self.closed = False
 
     self._buffer = collections.deque()
+    self._buffer_start = 0
     self._buffered = 0
     self._written = 0
     self._offset = 0
 
-    headers = {'x-goog-resumable': 'start'}
+    self._headers = {}
     if content_type:
-      headers['content-type'] = content_type
+      self._headers['content-type'] = content_type
     if gcs_headers:
-      headers.update(gcs_headers)
-    status, resp_headers, content = self._api.post_object(path, headers=headers)
-    errors.check_status(status, [201], path, headers, resp_headers,
-                        body=content)
-    loc = resp_headers.get('location')
-    if not loc:
-      raise IOError('No location header found in 201 response')
-    parsed = urlparse.urlparse(loc)
-    self._path_with_token = '%s?%s' % (self._path, parsed.query)
+      self._headers.update(gcs_headers)
+    self._path_with_token = None
+    self._async_flush = async_flush
+    self._send_future = None
 
   def __getstate__(self):
     """Store state as part of serialization/pickling.
@@ -667,14 +939,23 @@ class StreamingBuffer(object):
     last write. In the worst case the pickled version of this object may be
     slightly larger than the blocksize.
 
+    A chunk upload still in flight is waited for, since futures can't be
+    pickled.
+
     Returns:
       A dictionary with the state of this object
 
     """
+    self._wait_for_send()
+    buf = collections.deque(self._buffer)
+    if self._buffer_start:
+      buf[0] = buf[0][self._buffer_start:]
     return {'api': self._api,
             'path': self._path,
             'path_token': self._path_with_token,
-            'buffer': self._buffer,
+            'headers': self._headers,
+            'async_flush': self._async_flush,
+            'buffer': buf,
             'buffered': self._buffered,
             'written': self._written,
             'offset': self._offset,
@@ -688,7 +969,14 @@ class StreamingBuffer(object):
     """
     self._api = state['api']
     self._path_with_token = state['path_token']
-    self._buffer = state['buffer']
+    self._headers = state.get('headers', {})
+    self._async_flush = state.get('async_flush', False)
+    self._send_future = None
+    buf = state['buffer']
+    if isinstance(buf, str):
+      buf = collections.deque([buf] if buf else [])
+    self._buffer = buf
+    self._buffer_start = 0
     self._buffered = state['buffered']
     self._written = state['written']
     self._offset = state['offset']
@@ -757,48 +1045,101 @@ class StreamingBuffer(object):
     least self._blocksize, or to flush the final (incomplete) block of
     the file with finish=True.
     """
+    if self._path_with_token is None:
+      if finish and self._buffered <= self._maxrequestsize:
+        data = self._take(self._buffered)
+        self._send_object(data)
+        self._written += len(data)
+        return
+      if not finish and self._buffered < self._blocksize:
+        return
+      self._start_upload()
+
     while ((finish and self._buffered >= 0) or
            (not finish and self._buffered >= self._blocksize)):
-      tmp_buffer = []
-      tmp_buffer_len = 0
-
-      excess = 0
-      while self._buffer:
-        buf = self._buffer.popleft()
-        size = len(buf)
-        self._buffered -= size
-        tmp_buffer.append(buf)
-        tmp_buffer_len += size
-        if tmp_buffer_len >= self._maxrequestsize:
-          excess = tmp_buffer_len - self._maxrequestsize
-          break
-        if not finish and (
-            tmp_buffer_len % self._blocksize + self._buffered <
-            self._blocksize):
-          excess = tmp_buffer_len % self._blocksize
-          break
+      size = min(self._buffered, self._maxrequestsize)
+      if not finish:
+        size -= size % self._blocksize
+      data = self._take(size)
 
-      if excess:
-        over = tmp_buffer.pop()
-        size = len(over)
-        assert size >= excess
-        tmp_buffer_len -= size
-        head, tail = over[:-excess], over[-excess:]
-        self._buffer.appendleft(tail)
-        self._buffered += len(tail)
-        if head:
-          tmp_buffer.append(head)
-          tmp_buffer_len += len(head)
-
-      data = ''.join(tmp_buffer)
       file_len = '*'
       if finish and not self._buffered:
-        file_len = self._written + len(data)
-      self._send_data(data, self._written, file_len)
-      self._written += len(data)
+        file_len = self._written + size
+      self._wait_for_send()
+      if self._async_flush and file_len == '*':
+        self._send_future = self._send_data_async(data, self._written,
+                                                  file_len)
+      else:
+        self._send_data(data, self._written, file_len)
+      self._written += size
       if file_len != '*':
         break
 
+  def _take(self, size):
+    """Remove the first size bytes from the buffer.
+
+    Args:
+      size: number of bytes to remove. At most self._buffered.
+
+    Returns:
+      The bytes as one str. A single written string is returned as is.
+    """
+    parts = []
+    remaining = size
+    while remaining:
+      buf = self._buffer[0]
+      start = self._buffer_start
+      available = len(buf) - start
+      if available <= remaining:
+        self._buffer.popleft()
+        self._buffer_start = 0
+        parts.append(buf[start:] if start else buf)
+        remaining -= available
+      else:
+        parts.append(buf[start:start + remaining])
+        self._buffer_start += remaining
+        remaining = 0
+    self._buffered -= size
+    return ''.join(parts)
+
+  def _start_upload(self):
+    """Start a resumable upload and remember its upload path.
+
+    Raises:
+      IOError: When this location can not be found.
+    """
+    headers = {'x-goog-resumable': 'start'}
+    headers.update(self._headers)
+    status, resp_headers, content = self._api.post_object(self._path,
+                                                          headers=headers)
+    errors.check_status(status, [201], self._path, headers, resp_headers,
+                        body=content)
+    loc = resp_headers.get('location')
+    if not loc:
+      raise IOError('No location header found in 201 response')
+    parsed = urlparse.urlparse(loc)
+    self._path_with_token = '%s?%s' % (self._path, parsed.query)
+
+  def _send_object(self, data):
+    """Create the whole object with a single request.
+
+    This is a utility method that does not modify self.
+
+    Args:
+      data: the entire content of the file in str.
+    """
+    headers = dict(self._headers)
+    status, response_headers, content = self._api.put_object(
+        self._path, payload=data, headers=headers)
+    errors.check_status(status, [200], self._path, headers,
+                        response_headers, content)
+
+  def _wait_for_send(self):
+    """Wait for the chunk upload in flight, if any, and check its result."""
+    if self._send_future is not None:
+      send_future, self._send_future = self._send_future, None
+      send_future.get_result()
+
   def _send_data(self, data, start_offset, file_len):
     """Send the block to the storage service.
 
@@ -810,17 +1151,37 @@ class StreamingBuffer(object):
       file_len: an int if this is the last data to append to the file.
         Otherwise '*'.
     """
-    headers = {}
-    end_offset = start_offset + len(data) - 1
+    headers = self._send_data_headers(data, start_offset, file_len)
+    status, response_headers, content = self._api.put_object(
+        self._path_with_token, payload=data, headers=headers)
+    self._check_send_data(file_len, headers, status, response_headers,
+                          content)
 
-    if data:
-      headers['content-range'] = ('bytes %d-%d/%s' %
-                                  (start_offset, end_offset, file_len))
-    else:
-      headers['content-range'] = ('bytes */%s' % file_len)
+  @api_utils._eager_tasklet
+  @ndb.tasklet
+  def _send_data_async(self, data, start_offset, file_len):
+    """Async version of _send_data.
 
-    status, response_headers, content = self._api.put_object(
+    Runs eagerly, so the request is on its way when this returns rather
+    than when the future is first waited for.
+    """
+    headers = self._send_data_headers(data, start_offset, file_len)
+    status, response_headers, content = yield self._api.put_object_async(
         self._path_with_token, payload=data, headers=headers)
+    self._check_send_data(file_len, headers, status, response_headers,
+                          content)
+
+  def _send_data_headers(self, data, start_offset, file_len):
+    """Request headers of a _send_data call."""
+    if data:
+      end_offset = start_offset + len(data) - 1
+      return {'content-range': ('bytes %d-%d/%s' %
+                                (start_offset, end_offset, file_len))}
+    return {'content-range': 'bytes */%s' % file_len}
+
+  def _check_send_data(self, file_len, headers, status, response_headers,
+                       content):
+    """Check the response to a _send_data call."""
     if file_len == '*':
       expected = 308
     else:
@@ -838,6 +1199,10 @@ class StreamingBuffer(object):
       an int of the last offset written to GCS by this upload, inclusive.
       -1 means nothing has been written.
     """
+    self._wait_for_send()
+    if self._path_with_token is None:
+      # The resumable upload is only started once a block is flushed.
+      return -1
     headers = {'content-range': 'bytes */*'}
     status, response_headers, content = self._api.put_object(
         self._path_with_token, headers=headers)
@@ -864,6 +1229,8 @@ class StreamingBuffer(object):
     """
     if file_length is None:
       file_length = self._get_offset_from_gcs() + 1
+    if self._path_with_token is None:
+      self._start_upload()
     self._send_data('', 0, file_length)
 
   def _check_open(self):
@@ -1,21 +1,106 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import logging
+import time
 
+import cloudstorage as gcs
+from google.appengine.api import app_identity
 from google.appengine.ext import ndb
 import webapp2
-from model import Account
+from model import Account, Attachment, OrphanSweep, ATTACHMENT_HOUR_FORMAT, hourly_attachments_dir
+from profiling import ProfilingMiddleware
+
+
+ACCOUNT_CLEAR_DELAY_SECONDS = 60
+ORPHAN_SWEEP_MAX_MESSAGES = 100
+ORPHAN_SWEEP_MAX_CONCURRENT_DELETES = 5
+ORPHANED_ATTACHMENT_GRACE_SECONDS = 3600
+ATTACHMENT_DROP_BATCH_FILES = 1000
+# Cron requests have a 10 minute deadline, leave time for the batch in progress
+ATTACHMENT_DROP_TIME_BUDGET_SECONDS = 8 * 60
+ATTACHMENT_DROP_MAX_CONCURRENT_DELETES = 20
 
 
 class ClearAccountsHandler(webapp2.RequestHandler):
 
     def get(self):
+        # Messages are found through an eventually consistent index, so give the
+        # last ones stored before the account expired time to show up in it
+        cleared_before = datetime.now() - timedelta(seconds=ACCOUNT_CLEAR_DELAY_SECONDS)
         accounts_to_clear = Account.query(
-            ndb.AND(Account.valid_until < datetime.now(),
+            ndb.AND(Account.valid_until < cleared_before,
                     Account.cleared == False)
         ).fetch()
         for account in accounts_to_clear:
             account.clear()
 
 
-app = webapp2.WSGIApplication([
-    webapp2.Route('/_cron/clearAccounts', ClearAccountsHandler)
-], debug=True)
\ No newline at end of file
+class CollectOrphanedAttachmentsHandler(webapp2.RequestHandler):
+
+    # Checks one page of message directories per run and resumes from the saved marker
+    def get(self):
+        sweep = OrphanSweep.get_or_insert('attachments')
+        attachments_dir = '/%s/attachments/' % app_identity.get_default_gcs_bucket_name()
+        listed_dirs = [stat.filename for stat in gcs.listbucket(
+            attachments_dir, marker=sweep.marker, delimiter='/', max_keys=ORPHAN_SWEEP_MAX_MESSAGES
+        ) if stat.is_dir]
+        # The hourly directory is dropped as a whole by DropExpiredAttachmentsHandler
+        message_dirs = [filename for filename in listed_dirs if filename[len(attachments_dir):-1].isdigit()]
+        # Files younger than that may belong to a mail that is still being stored
+        created_before = time.time() - ORPHANED_ATTACHMENT_GRACE_SECONDS
+        orphans = []
+        for message_dir in message_dirs:
+            referenced = Attachment.gcs_filenames_under(message_dir)
+            orphans.extend(stat.filename for stat in gcs.listbucket(message_dir)
+                           if stat.st_ctime < created_before and stat.filename not in referenced)
+        if orphans:
+            logging.info("Deleting %d orphaned attachment files" % len(orphans))
+            errors = gcs.delete_multi(orphans, max_concurrent=ORPHAN_SWEEP_MAX_CONCURRENT_DELETES)
+            for filename, error in zip(orphans, errors):
+                if error is not None and not isinstance(error, gcs.NotFoundError):
+                    logging.warning('Failed to delete orphaned file %s: %s' % (filename, error))
+        if len(listed_dirs) < ORPHAN_SWEEP_MAX_MESSAGES:
+            sweep.marker = None
+        else:
+            sweep.marker = listed_dirs[-1]
+        sweep.put()
+
+
+class DropExpiredAttachmentsHandler(webapp2.RequestHandler):
+
+    # An hour's directory only holds files written during that hour. Clearing an account
+    # deletes the Attachment entities of its files there, so the directory can go once
+    # none of them is left, however long other accounts that wrote elsewhere live on
+    def get(self):
+        # Files younger than that may belong to a mail that is still being stored
+        drop_before = datetime.now() - timedelta(hours=1, seconds=ORPHANED_ATTACHMENT_GRACE_SECONDS)
+        stop_at = time.time() + ATTACHMENT_DROP_TIME_BUDGET_SECONDS
+        hours_dir = hourly_attachments_dir()
+        for hour_stat in gcs.listbucket(hours_dir, delimiter='/'):
+            hour = datetime.strptime(hour_stat.filename[len(hours_dir):-1], ATTACHMENT_HOUR_FORMAT)
+            if hour >= drop_before:
+                break
+            if Attachment.has_gcs_files_under(hour_stat.filename):
+                continue
+            # Listing on from the last file keeps files that failed to delete from coming back
+            marker = None
+            while True:
+                if time.time() >= stop_at:
+                    return
+                filenames = [stat.filename for stat in gcs.listbucket(
+                    hour_stat.filename, marker=marker, max_keys=ATTACHMENT_DROP_BATCH_FILES)]
+                if not filenames:
+                    break
+                logging.info("Dropping %d attachment files from %s" % (len(filenames), hour_stat.filename))
+                errors = gcs.delete_multi(filenames, max_concurrent=ATTACHMENT_DROP_MAX_CONCURRENT_DELETES)
+                for filename, error in zip(filenames, errors):
+                    if error is not None and not isinstance(error, gcs.NotFoundError):
+                        logging.warning('Failed to delete expired file %s: %s' % (filename, error))
+                if len(filenames) < ATTACHMENT_DROP_BATCH_FILES:
+                    break
+                marker = filenames[-1]
+
+app = ProfilingMiddleware(webapp2.WSGIApplication([
+    webapp2.Route('/_cron/clearAccounts', ClearAccountsHandler),
+    webapp2.Route('/_cron/collectOrphanedAttachments', CollectOrphanedAttachmentsHandler),
+    webapp2.Route('/_cron/dropExpiredAttachments', DropExpiredAttachmentsHandler),
+], debug=True), 'cron')
\ No newline at end of file
@@ -8,15 +8,17 @@ import re
 import cloudstorage as gcs
 import lxml
 from lxml.html.clean import clean_html
-from google.appengine.api import app_identity
+from google.appengine.ext import deferred
 from google.appengine.ext.webapp.mail_handlers import InboundMailHandler
 import webapp2
-from model import Account, Message, Attachment
+from model import Account, Message, Attachment, ATTACHMENT_HOUR_FORMAT, hourly_attachments_dir
+from profiling import ProfilingMiddleware, timed
 
 
 lxml.html.defs.safe_attrs |= {'style'}
 
 ADDRESS_HEADER_REGEX = re.compile(r'(.*)<(.+)>')
+DEFERRED_ATTACHMENT_COUNTDOWN = 60
 
 
 def parse_address_header(address_header):
@@ -28,10 +30,11 @@ def parse_address_header(address_header):
         return None, address_header.strip()
 
 
-def create_gcs_attachment_filename(message):
-    return '/%s/attachments/%d/%s' % (
-        app_identity.get_default_gcs_bucket_name(),
-        message.key.id(),
+def create_gcs_attachment_filename(message_key):
+    return '%s%s/%d/%s' % (
+        hourly_attachments_dir(),
+        datetime.now().strftime(ATTACHMENT_HOUR_FORMAT),
+        message_key.id(),
         str(uuid.uuid4()).replace('-', '')
     )
 
@@ -52,6 +55,32 @@ def get_attachment_size(data):
     return len(data)
 
 
+def store_attachment(data, filename, content_id, message_key, account_key=None):
+    gcs_filename = create_gcs_attachment_filename(message_key)
+    attachment_size = get_attachment_size(data)
+    logging.info("Storing attachment: name=\"%s\" size=%d" % (filename, attachment_size))
+    store_gcs_file(data, gcs_filename, filename)
+    db_attachment = Attachment(
+        parent=message_key,
+        account=account_key or message_key.parent(),
+        filename=filename,
+        content_id=content_id,
+        size=attachment_size,
+        gcs_filename=gcs_filename
+    )
+    db_attachment.put()
+
+
+def store_deferred_attachment(data, filename, content_id, message_key, account_key):
+    # The account may have expired or been cleared while the task was waiting,
+    # its attachment would then outlive the messages it belongs to
+    account = account_key.get()
+    if not account or account.cleared or not account.load_expiry().is_valid:
+        logging.info("Dropping deferred attachment of an expired account: %s" % filename)
+        return
+    store_attachment(data, filename, content_id, message_key, account_key)
+
+
 class IncomingMailHandler(InboundMailHandler):
 
     def receive(self, mail_message):
@@ -61,13 +90,20 @@ class IncomingMailHandler(InboundMailHandler):
     def _store_message(self, mail_message):
         receiver_name, receiver_address = parseaddr(mail_message.to)
         account = Account.get_by_email(receiver_address)
-        if not account or account.valid_until < datetime.now():
+        if not account:
+            account = Account.get_pending_by_email(receiver_address)
+            if account and account.is_valid:
+                account = account.persist()
+        if not account or not account.is_valid:
             return
         sender_name, sender_address = parseaddr(mail_message.sender)
         body = mail_message.body.decode() if hasattr(mail_message, 'body') else None
-        html = clean_html(mail_message.html.decode()) if hasattr(mail_message, 'html') else None
+        html = None
+        if hasattr(mail_message, 'html'):
+            with timed('clean_html'):
+                html = clean_html(mail_message.html.decode())
         db_message = Message(
-            parent=account.key,
+            account=account.key,
             sender_name=sender_name,
             sender_address=sender_address,
             receiver_name=receiver_name,
@@ -88,19 +124,19 @@ class IncomingMailHandler(InboundMailHandler):
             self._store_attachment(mail_attachment, db_message)
 
     def _store_attachment(self, mail_attachment, db_message):
-        gcs_filename = create_gcs_attachment_filename(db_message)
         data = mail_attachment.payload.decode()
-        attachment_size = get_attachment_size(data)
-        logging.info("Storing attachment: name=\"%s\" size=%d" % (mail_attachment.filename, attachment_size))
-        store_gcs_file(data, gcs_filename, mail_attachment.filename)
-        db_attachment = Attachment(
-            parent=db_message.key,
-            filename=mail_attachment.filename,
-            content_id=mail_attachment.content_id,
-            size=attachment_size,
-            gcs_filename=gcs_filename
-        )
-        db_attachment.put()
-
-
-app = webapp2.WSGIApplication([IncomingMailHandler.mapping()], debug=True)
+        args = (data, mail_attachment.filename, mail_attachment.content_id, db_message.key, db_message.account)
+        try:
+            store_attachment(*args)
+        except gcs.CircuitOpenError:
+            # GCS is failing, don't hold up the mail; the task queue retries until it recovers
+            logging.warning("GCS unavailable, deferring attachment: %s" % mail_attachment.filename)
+            try:
+                deferred.defer(store_deferred_attachment, *args, _countdown=DEFERRED_ATTACHMENT_COUNTDOWN)
+            except Exception as e:
+                # The pickled payload has to fit in a task or a single entity, larger attachments are lost
+                logging.error("Failed to defer attachment: %s" % mail_attachment.filename)
+                logging.exception(e)
+
+
+app = ProfilingMiddleware(webapp2.WSGIApplication([IncomingMailHandler.mapping()], debug=True), 'email_handler')
@@ -1,12 +1,19 @@
 import cgi
+from collections import deque
 from datetime import datetime, timedelta
+import hashlib
+import hmac
 import logging
+import os
 import string
+import threading
+import time
 
 import lxml.html
 import cloudstorage as gcs
-from google.appengine.api import app_identity
+from google.appengine.api import app_identity, memcache
 from google.appengine.ext import ndb, blobstore
+from profiling import timed
 
 
 BASE62_DIGITS = string.digits + string.letters
@@ -14,6 +21,17 @@ BASE62_SIZE = len(BASE62_DIGITS)
 EPOCH = datetime(1970, 1, 1)
 EMAIL_ADDRESS_PATTERN = '%s@%s.appspotmail.com'
 ACCOUNT_MAX_SECONDS = 600
+ATTACHMENT_URL_MAX_AGE = 3600
+ATTACHMENT_GCS_URL_MAX_AGE = 300
+ATTACHMENT_HOUR_FORMAT = '%Y%m%d%H'
+ACCOUNT_ID_BATCH_SIZE = 1000
+ACCOUNT_ID_LOW_WATER = 200
+PENDING_ACCOUNT_KEY = 'pending_account:%d'
+ACCOUNT_EXPIRY_KEY = 'account_expiry:%d'
+ACCOUNT_VALIDITY_SLACK_SECONDS = 300
+# No earlier than the deployment that stopped storing messages in the account's entity group,
+# accounts created since then skip the ancestor queries for their old messages
+LEGACY_MESSAGES_CREATED_BEFORE = datetime(2026, 11, 1)
 
 
 def to_timestamp(datetime_):
@@ -28,13 +46,99 @@ def base62_encode(number):
     return result
 
 
-def create_unique_email_address():
-    _, number = Account.allocate_ids(1)
+def base62_decode(string_):
+    number = 0
+    for char in string_:
+        digit = BASE62_DIGITS.find(char)
+        if digit < 0:
+            return None
+        number = number * BASE62_SIZE + digit
+    return number
+
+
+def create_unique_email_address(number):
     user = base62_encode(number)
     application_id = app_identity.get_application_id()
     return EMAIL_ADDRESS_PATTERN % (user, application_id)
 
 
+def email_address_number(email):
+    number = base62_decode(email.partition('@')[0])
+    if number and create_unique_email_address(number) == email:
+        return number
+
+
+def sign_attachment_url(urlsafe_key, expires):
+    message = '%s:%d' % (urlsafe_key, expires)
+    return hmac.new(os.environ['SESSION_SECRET_KEY'], message, hashlib.sha256).hexdigest()
+
+
+def attachment_url_expiry():
+    # Aligned to ATTACHMENT_URL_MAX_AGE windows so that the same attachment gets
+    # the same URL for a while, which lets browsers and the edge cache reuse it
+    now = int(time.time())
+    return now - now % ATTACHMENT_URL_MAX_AGE + 2 * ATTACHMENT_URL_MAX_AGE
+
+
+class IdPool(object):
+    # Hands out IDs allocated for a model in batches, so that most callers don't need an RPC.
+    # IDs are only handed out once, unused ones are lost when the instance goes away.
+
+    def __init__(self, model, batch_size, low_water):
+        self.model = model
+        self.batch_size = batch_size
+        self.low_water = low_water
+        self._lock = threading.Lock()
+        self._ranges = deque()
+        self._available = 0
+        self._refilling = False
+
+    def take(self):
+        # Returns an ID and, when the pool ran low and this call started a refill, its future.
+        # The caller has to wait for that before its request ends, ideally alongside its own RPCs.
+        with self._lock:
+            number = self._pop()
+            refill = number is not None and self._available < self.low_water and not self._refilling
+            if refill:
+                self._refilling = True
+        if number is None:
+            first, last = self.model.allocate_ids(self.batch_size)
+            with self._lock:
+                self._push(first + 1, last)
+            return first, None
+        return number, self._refill_async() if refill else None
+
+    def _pop(self):
+        if not self._ranges:
+            return None
+        first, last = self._ranges.popleft()
+        if first < last:
+            self._ranges.appendleft((first + 1, last))
+        self._available -= 1
+        return first
+
+    def _push(self, first, last):
+        if first <= last:
+            self._ranges.append((first, last))
+            self._available += last - first + 1
+
+    @ndb.tasklet
+    def _refill_async(self):
+        try:
+            first, last = yield self.model.allocate_ids_async(self.batch_size)
+            with self._lock:
+                self._push(first, last)
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            with self._lock:
+                self._refilling = False
+
+
+def hourly_attachments_dir():
+    return '/%s/attachments/hourly/' % app_identity.get_default_gcs_bucket_name()
+
+
 def max_account_validity():
     return datetime.now() + \
         timedelta(seconds=ACCOUNT_MAX_SECONDS)
@@ -43,50 +147,160 @@ def max_account_validity():
 class Account(ndb.Model):
     email = ndb.StringProperty(required=True)
     created_at = ndb.DateTimeProperty(required=True, auto_now_add=True)
+    # Never earlier than the actual expiry, which extend_validity keeps in memcache,
+    # so ClearAccountsHandler can rely on it to never clear an account still in use
     valid_until = ndb.DateTimeProperty(required=True)
     cleared = ndb.BooleanProperty(required=True, default=False)
 
+    _expires_at = None
+
+    @property
+    def expires_at(self):
+        return self._expires_at or self.valid_until
+
     @property
     def expire_in(self):
-        return int((self.valid_until - datetime.now()).total_seconds())
+        return int((self.expires_at - datetime.now()).total_seconds())
 
     @property
     def is_valid(self):
-        return self.valid_until > datetime.now()
+        return self.expires_at > datetime.now()
+
+    @property
+    def may_have_legacy_messages(self):
+        return self.created_at < LEGACY_MESSAGES_CREATED_BEFORE
 
     @property
     def messages(self):
-        return Message.query(ancestor=self.key).order(-Message.date)
+        # Only the listing comes from the eventually consistent index, the messages themselves are read by key
+        keys = Message.query(Message.account == self.key).order(-Message.date).fetch(keys_only=True)
+        # Messages used to be stored in the account's entity group, the ancestor query picks those up
+        legacy_keys = Message.query(ancestor=self.key).fetch(keys_only=True) if self.may_have_legacy_messages else []
+        messages = [message for message in ndb.get_multi(keys + legacy_keys) if message is not None]
+        if legacy_keys:
+            messages.sort(key=lambda message: message.date, reverse=True)
+        return messages
 
     @classmethod
     def get_by_email(cls, email):
-        return cls.query(Account.email == email).get()
+        number = email_address_number(email)
+        account = cls.get_by_id(number) if number else None
+        if not account or account.email != email:
+            # Accounts created before their ID was the address number
+            account = cls.query(Account.email == email).get()
+        if account:
+            return account.load_expiry()
 
     @classmethod
-    def create(cls):
-        account = cls(
-            email=create_unique_email_address(),
-            valid_until=max_account_validity()
+    def get_pending_by_email(cls, email):
+        number = email_address_number(email)
+        pending = memcache.get(PENDING_ACCOUNT_KEY % number) if number else None
+        if pending:
+            return cls.from_pending(number, *pending)
+
+    @classmethod
+    def from_pending(cls, number, created_at, valid_until):
+        return cls(
+            id=number,
+            email=create_unique_email_address(number),
+            created_at=created_at,
+            valid_until=valid_until
         )
-        account.put()
+
+    @classmethod
+    def create(cls, pending=False):
+        number, refill = account_ids.take()
+        account = cls.from_pending(number, datetime.now(), max_account_validity())
+        if pending:
+            # Not stored until it is needed, only the inbound mail path has to be able to find it
+            future = ndb.get_context().memcache_set(
+                PENDING_ACCOUNT_KEY % number, (account.created_at, account.valid_until),
+                time=ACCOUNT_MAX_SECONDS)
+        else:
+            future = account.put_async()
+        if refill:
+            refill.wait()
+        future.check_success()
         logging.info("Account created: %s" % account.email)
         return account
 
+    def keep_pending(self):
+        # The session outlives an evicted memcache entry, so put it back for the inbound mail path
+        memcache.add(PENDING_ACCOUNT_KEY % self.key.id(), (self.created_at, self.valid_until),
+                     time=max(self.expire_in, 1))
+
+    def persist(self):
+        # Stores a pending account, unless someone else did first
+        @ndb.transactional
+        def insert():
+            account = self.key.get()
+            if account is None:
+                account = self
+                account.put()
+            elif account.valid_until < self.valid_until:
+                account.valid_until = self.valid_until
+                account.put()
+            return account
+        account = insert()
+        if account is not self:
+            account.load_expiry()
+        logging.info("Account persisted: %s" % account.email)
+        return account
+
+    def discard(self):
+        # Closes a pending account, which may have been stored in the meantime
+        memcache.delete(PENDING_ACCOUNT_KEY % self.key.id())
+        account = self.key.get()
+        if account:
+            account.close()
+
+    def load_expiry(self):
+        expires_at = memcache.get(ACCOUNT_EXPIRY_KEY % self.key.id())
+        if expires_at:
+            self._expires_at = min(expires_at, self.valid_until)
+        return self
+
     def close(self):
         self.valid_until = datetime.now()
+        self._expires_at = None
         self.put()
+        memcache.delete(ACCOUNT_EXPIRY_KEY % self.key.id())
         logging.info("Account closed: %s" % self.email)
 
-    def extend_validity(self):
-        self.valid_until = max_account_validity()
-        self.put()
+    def extend_validity(self, put=True):
+        # Pending accounts pass put=False, persist() then stores them along with the new expiry
+        expires_at = max_account_validity()
+        self._expires_at = expires_at
+        expiry_key = ACCOUNT_EXPIRY_KEY % self.key.id()
+        if memcache.set(expiry_key, expires_at, time=ACCOUNT_MAX_SECONDS + ACCOUNT_VALIDITY_SLACK_SECONDS):
+            changed = self.valid_until < expires_at
+            if changed:
+                # Stored with some slack, so that the extensions following shortly after don't need a write
+                self.valid_until = expires_at + timedelta(seconds=ACCOUNT_VALIDITY_SLACK_SECONDS)
+        else:
+            # An earlier expiry may be left in memcache, which load_expiry would take over the stored one
+            memcache.delete(expiry_key)
+            changed = True
+            self.valid_until = expires_at
+        if changed and put:
+            self.put()
         logging.info("Account validity extended: %s" % self.email)
 
     def clear(self):
         logging.info("Clearing account: %s" % self.email)
-        messages_to_delete = Message.query(ancestor=self.key).fetch()
-        for message in messages_to_delete:
-            message.delete()
+        # Messages used to be stored in the account's entity group, the ancestor queries pick those up
+        # Attachments added to such messages later have both, so the results can overlap
+        attachments = Attachment.query(Attachment.account == self.key).fetch()
+        message_keys = Message.query(Message.account == self.key).fetch(keys_only=True)
+        if self.may_have_legacy_messages:
+            attachments = dict((attachment.key, attachment) for attachment in
+                               attachments + Attachment.query(ancestor=self.key).fetch()).values()
+            message_keys = list(set(message_keys + Message.query(ancestor=self.key).fetch(keys_only=True)))
+        # Files in hourly prefixes are dropped along with their prefix by the cron job,
+        # only those stored before there was such a layout are deleted one by one
+        Attachment.delete_multi([attachment for attachment in attachments if not attachment.is_in_hourly_dir])
+        ndb.delete_multi([attachment.key for attachment in attachments if attachment.is_in_hourly_dir] +
+                         message_keys)
         self.cleared = True
         self.put()
 
@@ -97,7 +311,11 @@ class Account(ndb.Model):
         }
 
 
+account_ids = IdPool(Account, ACCOUNT_ID_BATCH_SIZE, ACCOUNT_ID_LOW_WATER)
+
+
 class Message(ndb.Model):
+    account = ndb.KeyProperty(kind=Account, required=False)
     sender_name = ndb.StringProperty(required=False)
     sender_address = ndb.StringProperty(required=True)
     receiver_name = ndb.StringProperty(required=False)
@@ -111,6 +329,10 @@ class Message(ndb.Model):
     html = ndb.TextProperty()
     read = ndb.BooleanProperty(required=True, default=False)
 
+    @property
+    def owner_key(self):
+        return self.account or self.key.parent()
+
     @property
     def attachments(self):
         return Attachment.query(Attachment.content_id == None, ancestor=self.key)
@@ -122,30 +344,33 @@ class Message(ndb.Model):
     @property
     def html_to_display(self):
         if self.html is not None:
-            tree = lxml.html.fromstring(self.html)
-
-            # Fix embedded content links
-            for content in self.embedded_contents:
-                content_id = content.content_id
-                if content_id.startswith('<') and content_id.endswith('>'):
-                    content_id = content_id[1:-1]
-                for node in tree.xpath("//*[@src='cid:%s']" % content_id):
-                    node.attrib['src'] = content.url
-
-            # Amend links to open in new tab
-            for link in tree.xpath("//a"):
-                link.attrib['target'] = "_blank"
-
-            return lxml.html.tostring(tree)
+            with timed('html_to_display'):
+                return self._render_html()
         elif self.body is not None:
             return cgi.escape(self.body).replace("\n", "<br>")
         else:
             return None
 
+    def _render_html(self):
+        tree = lxml.html.fromstring(self.html)
+
+        # Fix embedded content links
+        for content in self.embedded_contents:
+            content_id = content.content_id
+            if content_id.startswith('<') and content_id.endswith('>'):
+                content_id = content_id[1:-1]
+            for node in tree.xpath("//*[@src='cid:%s']" % content_id):
+                node.attrib['src'] = content.url
+
+        # Amend links to open in new tab
+        for link in tree.xpath("//a"):
+            link.attrib['target'] = "_blank"
+
+        return lxml.html.tostring(tree)
+
     def delete(self):
         attachments_to_delete = Attachment.query(ancestor=self.key).fetch()
-        for attachment in attachments_to_delete:
-            attachment.delete()
+        Attachment.delete_multi(attachments_to_delete)
         self.key.delete()
 
     def api_repr(self, full=False):
@@ -168,14 +393,49 @@ class Attachment(ndb.Model):
     content_id = ndb.StringProperty(required=False)
     size = ndb.IntegerProperty(required=True)
     gcs_filename = ndb.StringProperty(required=True)
+    account = ndb.KeyProperty(kind=Account, required=False)
+
+    @property
+    def owner_key(self):
+        return self.account or self.key.parent().parent()
 
     @property
     def blobkey(self):
         return blobstore.BlobKey(blobstore.create_gs_key('/gs%s' % self.gcs_filename))
 
+    @property
+    def etag(self):
+        return '"%s"' % self.gcs_filename.rsplit('/', 1)[-1]
+
+    @property
+    def is_in_hourly_dir(self):
+        return self.gcs_filename.startswith(hourly_attachments_dir())
+
     @property
     def url(self):
-        return '/attachment/%s' % self.key.urlsafe()
+        urlsafe_key = self.key.urlsafe()
+        expires = attachment_url_expiry()
+        return '/attachment/%s?expires=%d&signature=%s' % (
+            urlsafe_key, expires, sign_attachment_url(urlsafe_key, expires))
+
+    @property
+    def gcs_url(self):
+        filename = self.filename
+        if type(filename) is unicode:
+            filename = filename.encode('utf8')
+        return gcs.signed_url(self.gcs_filename, expires_in=ATTACHMENT_GCS_URL_MAX_AGE, query_params={
+            'response-content-disposition': 'attachment; filename="%s"' % filename.replace('"', '')
+        })
+
+    @staticmethod
+    def is_url_signature_valid(urlsafe_key, expires, signature):
+        if expires < time.time():
+            return False
+        try:
+            signature = str(signature)
+        except UnicodeEncodeError:
+            return False
+        return hmac.compare_digest(sign_attachment_url(urlsafe_key, expires), signature)
 
     def delete(self):
         try:
@@ -184,10 +444,45 @@ class Attachment(ndb.Model):
             logging.warning('GCS file not found: %s' % self.gcs_filename)
         self.key.delete()
 
+    @classmethod
+    def _query_gcs_filenames_under(cls, prefix):
+        return cls.query(cls.gcs_filename >= prefix, cls.gcs_filename < prefix + u'\ufffd')
+
+    @classmethod
+    def gcs_filenames_under(cls, prefix):
+        query = cls._query_gcs_filenames_under(prefix)
+        return set(attachment.gcs_filename for attachment in query.fetch(projection=[cls.gcs_filename]))
+
+    @classmethod
+    def has_gcs_files_under(cls, prefix):
+        return cls._query_gcs_filenames_under(prefix).get(keys_only=True) is not None
+
+    @classmethod
+    def delete_multi(cls, attachments):
+        gcs_errors = gcs.delete_multi([attachment.gcs_filename for attachment in attachments])
+        deleted_keys = []
+        failed = None
+        for attachment, error in zip(attachments, gcs_errors):
+            if isinstance(error, gcs.NotFoundError):
+                logging.warning('GCS file not found: %s' % attachment.gcs_filename)
+            elif error is not None:
+                logging.error('Failed to delete GCS file %s: %s' % (attachment.gcs_filename, error))
+                failed = failed or error
+                continue
+            deleted_keys.append(attachment.key)
+        ndb.delete_multi(deleted_keys)
+        if failed:
+            raise failed
+
     def api_repr(self):
         return {
             'key': self.key.urlsafe(),
             'filename': self.filename,
             'size': self.size,
             'url': self.url
-        }
\ No newline at end of file
+        }
+
+
+class OrphanSweep(ndb.Model):
+    marker = ndb.StringProperty(required=False)
+    updated_at = ndb.DateTimeProperty(required=True, auto_now=True)
\ No newline at end of file
@@ -0,0 +1,168 @@
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import cProfile
+import logging
+import os
+import pstats
+import random
+import StringIO
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map, quota, runtime
+import webapp2
+
+
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE') or 0)
+PROFILE_MAX_SAMPLES = 5
+PROFILE_MAX_LINES = 40
+
+_request = threading.local()
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def _count_rpc(service, call, request, response):
+    rpcs = getattr(_request, 'rpcs', None)
+    if rpcs is not None:
+        rpcs[service] += 1
+
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('profiling_rpc_counter', _count_rpc)
+
+
+@contextmanager
+def timed(section):
+    # Adds the wall time of the block to the section timings of the current request
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        sections = getattr(_request, 'sections', None)
+        if sections is not None:
+            sections[section] += time.time() - start_time
+
+
+def _new_route_stats():
+    return {
+        'requests': 0,
+        'errors': 0,
+        'wall_total': 0.0,
+        'wall_max': 0.0,
+        # None where the runtime doesn't report the CPU time of a request
+        'cpu_total': None,
+        'rpcs': defaultdict(int),
+        'sections': defaultdict(float),
+        'peak_memory_mb': 0.0,
+        'profiles': deque(maxlen=PROFILE_MAX_SAMPLES),
+    }
+
+
+def _memory_usage():
+    try:
+        return runtime.memory_usage().current()
+    except Exception:
+        # Not every environment has the system service, e.g. the testbed
+        return None
+
+
+def _request_cpu_megacycles():
+    # Only the non-python27 runtimes define get_request_cpu_usage, there is no CPU time otherwise
+    get_request_cpu_usage = getattr(quota, 'get_request_cpu_usage', None)
+    return get_request_cpu_usage() if get_request_cpu_usage else None
+
+
+def _format_profile(profile):
+    out = StringIO.StringIO()
+    stats = pstats.Stats(profile, stream=out)
+    stats.sort_stats('cumulative').print_stats(PROFILE_MAX_LINES)
+    return out.getvalue()
+
+
+def get_stats():
+    with _stats_lock:
+        result = []
+        for (app_name, route), route_stats in sorted(_stats.items()):
+            route_stats = dict(route_stats)
+            route_stats['rpcs'] = dict(route_stats['rpcs'])
+            route_stats['sections'] = dict(route_stats['sections'])
+            route_stats['profiles'] = list(route_stats['profiles'])
+            route_stats['app'] = app_name
+            route_stats['route'] = route
+            result.append(route_stats)
+        return result
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+class ProfilingMiddleware(object):
+
+    def __init__(self, app, name):
+        self.app = app
+        self.name = name
+
+    def __call__(self, environ, start_response):
+        status = []
+
+        def profiled_start_response(status_line, headers, exc_info=None):
+            status.append(status_line)
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            route = self._match_route(environ)
+            _request.rpcs = defaultdict(int)
+            _request.sections = defaultdict(float)
+            profile = cProfile.Profile() if random.random() < PROFILE_SAMPLE_RATE else None
+            start_cpu = _request_cpu_megacycles()
+        except Exception as e:
+            # Profiling must never fail the request itself
+            logging.exception(e)
+            _request.rpcs = _request.sections = None
+            return self.app(environ, start_response)
+        start_time = time.time()
+        try:
+            if profile:
+                return profile.runcall(self.app, environ, profiled_start_response)
+            return self.app(environ, profiled_start_response)
+        finally:
+            wall = time.time() - start_time
+            self._record(route, status, wall, start_cpu, profile)
+            _request.rpcs = _request.sections = None
+
+    def _match_route(self, environ):
+        try:
+            match = self.app.router.match(webapp2.Request(environ))
+        except Exception:
+            return None
+        return getattr(match[0], 'template', None) if match else None
+
+    def _record(self, route, status, wall, start_cpu, profile):
+        try:
+            end_cpu = _request_cpu_megacycles()
+            cpu = quota.megacycles_to_cpu_seconds(end_cpu - start_cpu) if start_cpu is not None else None
+            memory = _memory_usage()
+            formatted_profile = _format_profile(profile) if profile else None
+            with _stats_lock:
+                route_stats = _stats.get((self.name, route))
+                if route_stats is None:
+                    route_stats = _stats[(self.name, route)] = _new_route_stats()
+                route_stats['requests'] += 1
+                if not status or status[0][:1] == '5':
+                    route_stats['errors'] += 1
+                route_stats['wall_total'] += wall
+                route_stats['wall_max'] = max(route_stats['wall_max'], wall)
+                if cpu is not None:
+                    route_stats['cpu_total'] = (route_stats['cpu_total'] or 0.0) + cpu
+                for service, count in _request.rpcs.iteritems():
+                    route_stats['rpcs'][service] += count
+                for section, seconds in _request.sections.iteritems():
+                    route_stats['sections'][section] += seconds
+                if memory is not None:
+                    route_stats['peak_memory_mb'] = max(route_stats['peak_memory_mb'], memory)
+                if formatted_profile:
+                    route_stats['profiles'].append({'time': time.time(), 'wall': wall, 'profile': formatted_profile})
+        except Exception as e:
+            logging.exception(e)
\ No newline at end of file